@@ -1,42 +1,113 @@
 import streamlit as st
-import json
-import os
 from datetime import datetime
-import time
+import uuid
+from notifier import shared_notifier
+from message_log import MESSAGES_LOG, message_id, message_key
+from message_render import render_messages
+from message_store import SQLITE_FILE, TIMESTAMP_FORMAT, JsonFileStore, SqliteStore
+from metrics import shared_metrics
+from retention import ARCHIVE_DIR, LocalArchive, RetentionEngine, RetentionPolicy
+from rooms import DEFAULT_ROOM, check_rooms, room_path, rooms_for
 
 # Configuration
 USERS = {
     "khizar": {"name": "Khizar", "password": "khizar123"},
     "ahad": {"name": "Ahad", "password": "ahad123"}
 }
+# Chat rooms and their members; each room keeps its messages in its own files
+ROOMS = {
+    DEFAULT_ROOM: {"name": "General", "members": ["khizar", "ahad"]},
+}
+check_rooms(USERS, ROOMS)
+
+MESSAGES_FILE = "messages.json"  # Legacy storage, migrated into the message log
+STORAGE_BACKEND = "jsonl"  # "jsonl" (messages.jsonl) or "sqlite" (SQLITE_FILE)
+MESSAGE_WINDOW = 50  # Number of recent messages shown in the chat
+MESSAGE_REFRESH_INTERVAL = 1  # Seconds between checks for new messages
+HISTORY_PAGE_SIZE = 50  # Older messages loaded per "load older" click
+HISTORY_MAX_PAGES = 4  # Older pages kept on screen (and in session state)
+# Auto-cleanup: past these limits older messages move to compressed archives in ARCHIVE_DIR (None = no limit)
+RETENTION_MAX_MESSAGES = None
+RETENTION_MAX_AGE_DAYS = None
+RETENTION_MAX_KB = None
+# Timings, reruns and delivery latency, written every 15 seconds as a Prometheus text file and/or a JSON lines log (None = off)
+METRICS_TEXTFILE = None
+METRICS_LOG = None
+
+@st.cache_resource
+def get_room_store(room):
+    """Message store of ``room``, shared by every session"""
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStore(room_path(SQLITE_FILE, room))
+    if room != DEFAULT_ROOM:
+        return JsonFileStore(room_path(MESSAGES_LOG, room), legacy_path=None)
+    # Moves an old messages.json into the log and numbers messages stored
+    # before IDs existed (first run only)
+    return JsonFileStore(legacy_path=MESSAGES_FILE)
 
-MESSAGES_FILE = "messages.json"
+def get_store():
+    """Message store of the room this session is in"""
+    return get_room_store(st.session_state.room)
+
+@st.cache_resource
+def get_retention_engine(room):
+    """Background auto-cleanup of ``room``, shared by every session"""
+    policy = RetentionPolicy(RETENTION_MAX_MESSAGES, RETENTION_MAX_AGE_DAYS, (RETENTION_MAX_KB or 0) * 1024)
+    return RetentionEngine(get_room_store(room), LocalArchive(room_path(ARCHIVE_DIR, room)), policy).start()
+
+def retention_enabled():
+    """Whether any auto-cleanup limit is set"""
+    return bool(RETENTION_MAX_MESSAGES or RETENTION_MAX_AGE_DAYS or RETENTION_MAX_KB)
 
 def load_messages():
-    """Load messages from JSON file"""
-    if os.path.exists(MESSAGES_FILE):
-        try:
-            with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+    """Load every stored message"""
+    try:
+        return get_store().all()
+    except OSError:
+        return []
+
+def load_recent_messages(limit=MESSAGE_WINDOW):
+    """Load only the last ``limit`` messages"""
+    try:
+        return get_store().recent(limit)[0]
+    except OSError:
+        return []
+
+def load_messages_since(since_id):
+    """Load the messages stored after the message with ID ``since_id``"""
+    try:
+        return get_store().since(since_id)[0]
+    except OSError:
+        return []
+
+def load_older_messages(cursor, limit=HISTORY_PAGE_SIZE):
+    """Load a page of messages older than ``cursor`` and the cursor for the page before it"""
+    try:
+        return get_store().older(cursor, limit)
+    except OSError:
+        return [], None
+
+def search_messages(query, users=None, start=None, end=None):
+    """Find the newest messages containing every word of ``query`` (``word*`` for prefixes)"""
+    try:
+        return get_store().search(query, users, start, end)
+    except OSError:
+        return []
 
 def save_messages(messages):
-    """Save messages to JSON file"""
-    with open(MESSAGES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(messages, f, ensure_ascii=False, indent=2)
+    """Replace every stored message with the given messages"""
+    get_store().replace_all(messages)
 
 def add_message(username, message):
     """Add a new message to the chat"""
-    messages = load_messages()
-    new_message = {
+    message = {
         "username": username,
         "message": message,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        "timestamp": datetime.now().strftime(TIMESTAMP_FORMAT)
     }
-    messages.append(new_message)
-    save_messages(messages)
+    # Delivery latency runs from here until the message shows up on a screen
+    shared_metrics.message_sent(message_key(message))
+    return get_store().append([message])[0]
 
 def login_page():
     """Display login page"""
@@ -47,16 +118,20 @@ def login_page():
     
     with col2:
         with st.form("login_form"):
-            username = st.selectbox("Select User:", ["", "khizar", "ahad"])
+            username = st.selectbox("Select User:", [""] + list(USERS))
             password = st.text_input("Password:", type="password")
             submit = st.form_submit_button("Login", use_container_width=True)
             
             if submit:
                 if username and password:
                     if username in USERS and USERS[username]["password"] == password:
+                        if not rooms_for(ROOMS, username):
+                            st.error("❌ You are not a member of any room!")
+                            return
                         st.session_state.logged_in = True
                         st.session_state.username = username
                         st.session_state.display_name = USERS[username]["name"]
+                        st.session_state.room = rooms_for(ROOMS, username)[0]
                         st.rerun()
                     else:
                         st.error("❌ Invalid credentials!")
@@ -68,6 +143,133 @@ def login_page():
         st.write("**Khizar's password:** khizar123")
         st.write("**Ahad's password:** ahad123")
 
+def display_name(username):
+    """Name shown on someone's messages"""
+    return USERS[username]["name"] if username in USERS else username
+
+def room_members():
+    """Usernames of the members of this session's room"""
+    return ROOMS[st.session_state.room]["members"]
+
+def switch_room():
+    """Show the room picked in the room selector"""
+    st.session_state.room = st.session_state.room_choice
+    for key in ['messages_version', 'visible_messages', 'search_results']:
+        st.session_state.pop(key, None)
+    close_history()
+
+def close_history():
+    """Go back to showing only the latest messages"""
+    for key in ['history_pages', 'history_cursor', 'history_html', 'older_probe']:
+        st.session_state.pop(key, None)
+
+def history_cursor():
+    """Where the next "load older" page starts (None when nothing older is left)"""
+    if 'history_cursor' in st.session_state:
+        return st.session_state.history_cursor
+    visible = st.session_state.get('visible_messages')
+    if not visible:
+        return None
+    first = message_id(visible[0])
+    if st.session_state.get('older_probe', (None, False))[0] != first:
+        # Looked up once per window, so the button only shows when there is more
+        st.session_state.older_probe = (first, bool(load_older_messages(first, 1)[0]))
+    return first if st.session_state.older_probe[1] else None
+
+def load_older_page():
+    """Add the page before the oldest one on screen"""
+    page, cursor = load_older_messages(history_cursor())
+    pages = st.session_state.get('history_pages', [])
+    if page:
+        # Only the pages on screen are kept; the newest one drops off
+        pages = ([page] + pages)[:HISTORY_MAX_PAGES]
+        st.session_state.history_html = render_messages(
+            [m for p in pages for m in p], st.session_state.username, display_name
+        )
+    st.session_state.history_pages = pages
+    st.session_state.history_cursor = cursor
+
+def older_messages_area():
+    """Older messages above the latest ones, loaded a page at a time"""
+    if history_cursor() is not None:
+        st.button("⬆️ Load older messages", on_click=load_older_page)
+    
+    pages = st.session_state.get('history_pages')
+    if pages:
+        st.markdown(st.session_state.history_html, unsafe_allow_html=True)
+        if message_id(pages[-1][-1]) + 1 < message_id(st.session_state.visible_messages[0]):
+            st.caption("⋯ newer messages hidden ⋯")
+        st.button("⬇️ Back to latest", on_click=close_history)
+        st.markdown("---")
+
+def search_panel():
+    """Search the whole history through the full-text index"""
+    with st.expander("🔍 Search messages"):
+        with st.form("search_form"):
+            query = st.text_input("Search for:", placeholder="Words to find - end one with * to match its beginning")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                users = st.multiselect("From:", room_members(), default=room_members(), format_func=display_name)
+            with col2:
+                start = st.date_input("Since:", value=None)
+            with col3:
+                end = st.date_input("Until:", value=None)
+            submitted = st.form_submit_button("Search")
+        
+        if submitted:
+            st.session_state.search_results = search_messages(
+                query,
+                users=None if set(users) == set(room_members()) else users,
+                start=f"{start:%Y-%m-%d}" if start else None,
+                end=f"{end:%Y-%m-%d} 23:59:59" if end else None
+            ) if query.strip() else None
+        
+        results = st.session_state.get('search_results')
+        if results:
+            st.caption(f"{len(results)} newest matching message{'s' if len(results) != 1 else ''}")
+            st.markdown(render_messages(
+                reversed(results), st.session_state.username, display_name
+            ), unsafe_allow_html=True)
+        elif results is not None:
+            st.info("No messages found")
+
+@st.fragment(run_every=MESSAGE_REFRESH_INTERVAL)
+@shared_metrics.timed("rerun.message_list")
+def message_area():
+    """Display the message list, refreshing on its own when new messages arrive"""
+    shared_metrics.rerun(st.session_state.session_id, "fragment")
+    # Only read storage when a send was published or the stored messages changed
+    store = get_store()
+    version = (shared_notifier.version(store.key), store.version())
+    if st.session_state.get('messages_version') != version:
+        rewritten = shared_notifier.version(store.rewritten_key)
+        if not st.session_state.get('visible_messages') or st.session_state.get('rewritten_version') != rewritten:
+            messages = load_recent_messages(MESSAGE_WINDOW)
+            close_history()
+        else:
+            # Keep what is already shown and add only the new messages
+            new_messages = load_messages_since(message_id(st.session_state.visible_messages[-1]))
+            shared_metrics.messages_shown([message_key(m) for m in new_messages])
+            messages = (st.session_state.visible_messages + new_messages)[-MESSAGE_WINDOW:]
+        st.session_state.visible_messages = messages
+        # Message bubbles are cached, so only new messages are formatted
+        st.session_state.visible_html = render_messages(
+            messages, st.session_state.username, display_name
+        )
+        st.session_state.rewritten_version = rewritten
+        st.session_state.messages_version = version
+    
+    # Create a container for messages
+    message_container = st.container()
+
+    with message_container:
+        if st.session_state.visible_messages:
+            older_messages_area()
+            # The whole list is one element
+            st.markdown(st.session_state.visible_html, unsafe_allow_html=True)
+        else:
+            st.info("No messages yet. Start the conversation!")
+
 def chat_page():
     """Display chat interface"""
     # Header
@@ -77,62 +279,29 @@ def chat_page():
             st.session_state.logged_in = False
             st.session_state.username = None
             st.session_state.display_name = None
+            st.session_state.room = DEFAULT_ROOM
+            st.session_state.pop('messages_version', None)
+            st.session_state.pop('visible_messages', None)
+            st.session_state.pop('search_results', None)
+            close_history()
             st.rerun()
     
     with col2:
         st.title(f"💬 Chat - Welcome {st.session_state.display_name}!")
+        rooms = rooms_for(ROOMS, st.session_state.username)
+        if len(rooms) > 1:
+            st.selectbox(
+                "Room:", rooms, index=rooms.index(st.session_state.room), format_func=lambda r: ROOMS[r]["name"],
+                key="room_choice", on_change=switch_room
+            )
     
     with col3:
         if st.button("🔄 Refresh"):
+            st.session_state.pop('messages_version', None)
             st.rerun()
     
-    # Auto-refresh every 5 seconds
-    if 'last_refresh' not in st.session_state:
-        st.session_state.last_refresh = time.time()
-    
-    # Display messages
-    messages = load_messages()
-    
-    # Create a container for messages
-    message_container = st.container()
-    
-    with message_container:
-        if messages:
-            for msg in messages[-50:]:  # Show last 50 messages
-                timestamp = msg["timestamp"]
-                username = msg["username"]
-                message_text = msg["message"]
-                display_name = USERS[username]["name"]
-                
-                # Different styling for current user vs other user
-                if username == st.session_state.username:
-                    # Current user's message (right-aligned)
-                    st.markdown(f"""
-                    <div style='text-align: right; margin: 10px 0;'>
-                        <div style='background-color: #007ACC; color: white; padding: 10px; border-radius: 15px; display: inline-block; max-width: 70%; text-align: left;'>
-                            <strong>You</strong><br>
-                            {message_text}
-                        </div>
-                        <div style='font-size: 12px; color: #666; margin-top: 5px;'>
-                            {timestamp}
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                else:
-                    # Other user's message (left-aligned)
-                    st.markdown(f"""
-                    <div style='text-align: left; margin: 10px 0;'>
-                        <div style='background-color: #E8E8E8; color: black; padding: 10px; border-radius: 15px; display: inline-block; max-width: 70%;'>
-                            <strong>{display_name}</strong><br>
-                            {message_text}
-                        </div>
-                        <div style='font-size: 12px; color: #666; margin-top: 5px;'>
-                            {timestamp}
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
-        else:
-            st.info("No messages yet. Start the conversation!")
+    # Display messages (refreshes on its own without rerunning the page)
+    message_area()
     
     # Message input form
     st.markdown("---")
@@ -147,12 +316,12 @@ def chat_page():
             add_message(st.session_state.username, new_message.strip())
             st.rerun()
     
-    # Auto-refresh mechanism
-    current_time = time.time()
-    if current_time - st.session_state.last_refresh > 5:  # Refresh every 5 seconds
-        st.session_state.last_refresh = current_time
-        time.sleep(0.1)  # Small delay to prevent too frequent refreshes
-        st.rerun()
+    search_panel()
+    
+    if retention_enabled():
+        engine = get_retention_engine(st.session_state.room)
+        if engine.last_error:
+            st.error(f"Last auto-cleanup failed: {engine.last_error}")
 
 def main():
     """Main application function"""
@@ -163,6 +332,11 @@ def main():
         st.session_state.username = None
     if 'display_name' not in st.session_state:
         st.session_state.display_name = None
+    if 'room' not in st.session_state:
+        st.session_state.room = DEFAULT_ROOM
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    shared_metrics.rerun(st.session_state.session_id, "page")
     
     # Set page config
     st.set_page_config(
@@ -182,11 +356,19 @@ def main():
     """
     st.markdown(hide_streamlit_style, unsafe_allow_html=True)
     
+    # Each room's auto-cleanup starts once someone opens it
+    if st.session_state.logged_in and retention_enabled():
+        get_retention_engine(st.session_state.room)
+    
+    if METRICS_TEXTFILE or METRICS_LOG:
+        shared_metrics.export(METRICS_TEXTFILE, METRICS_LOG)
+    
     # Route to appropriate page
-    if st.session_state.logged_in:
-        chat_page()
-    else:
-        login_page()
+    with shared_metrics.timer("rerun.page"):
+        if st.session_state.logged_in:
+            chat_page()
+        else:
+            login_page()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
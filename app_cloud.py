@@ -1,126 +1,436 @@
 import streamlit as st
-import json
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
-import requests
-from urllib.parse import quote
+import uuid
+from gist_client import GITHUB_API_URL, GistClient
+from gist_poller import GistPoller
+from gist_segments import SegmentedGist
+from message_log import message_id, message_key
+from message_render import render_messages
+from message_export import build_export
+from message_stats import new_stats
+from message_store import SQLITE_FILE, TIMESTAMP_FORMAT, MemoryStore, SqliteStore
+from metrics import METRIC_SAMPLES, shared_metrics
+from notifier import shared_notifier
+from retention import ARCHIVE_DIR, GistArchive, LocalArchive, RetentionEngine, RetentionPolicy
+from rooms import DEFAULT_ROOM, check_rooms, default_rooms, room_path, room_prefix, rooms_for
+from send_queue import SEND_FLUSH_INTERVAL, SEND_SPOOL_FILE, SendQueue
 
 # Configuration - can be overridden by Streamlit secrets
-USERS = {
+DEFAULT_USERS = {
     "khizar": {"name": "Khizar", "password": "khizar123", "is_admin": True},
     "ahad": {"name": "Ahad", "password": "ahad123", "is_admin": False}
 }
+# Users and chat rooms can be set in the secrets as [USERS.<username>] and [ROOMS.<room>] tables;
+# a room lists its "members" and may keep its messages in a Gist of its own ("gist_id")
+USERS = {username: dict(user) for username, user in st.secrets.get("USERS", DEFAULT_USERS).items()}
+ROOMS = {room: dict(config) for room, config in st.secrets.get("ROOMS", default_rooms(USERS)).items()}
+check_rooms(USERS, ROOMS)
 
 # Use GitHub Gist as a simple cloud database
 GITHUB_TOKEN = st.secrets.get("GITHUB_TOKEN", "")  # Set in Streamlit Cloud secrets
 GIST_ID = st.secrets.get("GIST_ID", "")  # Set in Streamlit Cloud secrets
+ARCHIVE_GIST_ID = st.secrets.get("ARCHIVE_GIST_ID", "")  # Optional second Gist for sealed history segments
+GIST_API_URL = st.secrets.get("GIST_API_URL", GITHUB_API_URL)  # Point at fake_gist_server.py for local testing
+STORAGE_BACKEND = st.secrets.get("STORAGE_BACKEND", "gist")  # "gist" or "sqlite" (needs a persistent disk)
+SQLITE_PATH = st.secrets.get("SQLITE_PATH", SQLITE_FILE)
+# Auto-cleanup limits (0 = no limit); older messages move to compressed archives
+RETENTION_MAX_MESSAGES = int(st.secrets.get("RETENTION_MAX_MESSAGES", 0))
+RETENTION_MAX_AGE_DAYS = int(st.secrets.get("RETENTION_MAX_AGE_DAYS", 0))
+RETENTION_MAX_KB = int(st.secrets.get("RETENTION_MAX_KB", 0))
+# Optional metric exports, rewritten every 15 seconds: a Prometheus text file and/or a JSON lines log
+METRICS_TEXTFILE = st.secrets.get("METRICS_TEXTFILE", "")
+METRICS_LOG = st.secrets.get("METRICS_LOG", "")
 
-def load_messages_cloud():
-    """Load messages from GitHub Gist (cloud storage)"""
-    if not GITHUB_TOKEN or not GIST_ID:
+MESSAGE_WINDOW = 50  # Number of recent messages shown in the chat
+CLOUD_CACHE_TTL = 3  # Seconds between a session's own checks of the shared cache
+MESSAGE_REFRESH_INTERVAL = 1  # Seconds between checks for new messages
+HISTORY_PAGE_SIZE = 50  # Older messages loaded per "load older" click
+HISTORY_MAX_PAGES = 4  # Older pages kept on screen (and in session state)
+
+def storage_configured():
+    """Whether messages go to persistent storage rather than the session"""
+    return STORAGE_BACKEND == "sqlite" or bool(GITHUB_TOKEN and GIST_ID)
+
+def uses_gist():
+    """Whether messages are kept in the Gist"""
+    return STORAGE_BACKEND != "sqlite" and storage_configured()
+
+def uses_send_queue():
+    """Gist writes are slow, so sends go through the background queue"""
+    return uses_gist()
+
+def room_gist(room):
+    """ID of the Gist holding ``room``'s messages"""
+    return ROOMS[room].get("gist_id") or GIST_ID
+
+@st.cache_resource
+def get_gist_client(gist_id):
+    """Pooled client of one Gist, shared by every room stored in it"""
+    return GistClient(gist_id, GITHUB_TOKEN, api_url=GIST_API_URL)
+
+@st.cache_resource
+def get_shared_store(room):
+    """Persistent message store of ``room`` with pooled connections, shared by every session"""
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStore(room_path(SQLITE_PATH, room))
+    archive_client = get_gist_client(ARCHIVE_GIST_ID) if ARCHIVE_GIST_ID else None
+    # Only the poller fetches the Gist; every open session reads its copy
+    return SegmentedGist(get_gist_client(room_gist(room)), archive_client, polled=True, prefix=room_prefix(room))
+
+def get_message_store():
+    """Message store of the room this session is in"""
+    if not storage_configured():
         # Fallback to session state for demo purposes
-        if 'messages' not in st.session_state:
-            st.session_state.messages = []
-        return st.session_state.messages
-    
+        stores = st.session_state.setdefault('message_stores', {})
+        if st.session_state.room not in stores:
+            stores[st.session_state.room] = MemoryStore()
+        return stores[st.session_state.room]
+    return get_shared_store(st.session_state.room)
+
+@st.cache_resource
+def get_send_queue(room):
+    """Outgoing message queue of ``room`` with its background flusher, shared by every session"""
+    store = get_shared_store(room)
+    return SendQueue(store.append, room_path(SEND_SPOOL_FILE, room), SEND_FLUSH_INTERVAL).start()
+
+@st.cache_resource
+def get_poller(gist_id):
+    """Background poll of one Gist, shared by every session and room"""
+    return GistPoller(get_gist_client(gist_id)).start()
+
+@st.cache_resource
+def get_retention_engine(room):
+    """Background auto-cleanup of ``room``'s persistent store, shared by every session"""
+    if STORAGE_BACKEND == "sqlite":
+        archive = LocalArchive(room_path(os.path.join(os.path.dirname(SQLITE_PATH), ARCHIVE_DIR), room))
+    else:
+        # With an archive Gist, polls of the main Gist never download the archives.
+        # Its own client: the polled one must only be refreshed by the poller
+        client = GistClient(ARCHIVE_GIST_ID or room_gist(room), GITHUB_TOKEN, api_url=GIST_API_URL)
+        archive = GistArchive(client, room_prefix(room))
+    policy = RetentionPolicy(RETENTION_MAX_MESSAGES, RETENTION_MAX_AGE_DAYS, RETENTION_MAX_KB * 1024)
+    return RetentionEngine(get_shared_store(room), archive, policy).start()
+
+def pending_messages_cloud(username):
+    """Messages from ``username`` that are queued but not yet in the Gist"""
+    if not uses_send_queue():
+        return []
+    return [m for m in get_send_queue(st.session_state.room).pending() if m["username"] == username]
+
+def load_messages_cloud():
+    """Load every message from cloud storage"""
     try:
-        headers = {
-            'Authorization': f'token {GITHUB_TOKEN}',
-            'Accept': 'application/vnd.github.v3+json'
-        }
-        response = requests.get(f'https://api.github.com/gists/{GIST_ID}', headers=headers)
-        if response.status_code == 200:
-            gist_data = response.json()
-            content = gist_data['files']['messages.json']['content']
-            return json.loads(content)
+        return get_message_store().all()
     except Exception as e:
         st.error(f"Error loading messages: {str(e)}")
     
     return []
 
+def load_recent_messages_cloud(limit=MESSAGE_WINDOW):
+    """Load the last ``limit`` messages plus the total message count"""
+    try:
+        messages, total = get_message_store().recent(limit)
+    except Exception as e:
+        st.error(f"Error loading messages: {str(e)}")
+        return [], 0
+    return messages, total or 0
+
+def load_messages_since_cloud(since_id):
+    """Load the messages stored after the message with ID ``since_id``, plus the total count"""
+    try:
+        messages, total = get_message_store().since(since_id)
+    except Exception as e:
+        st.error(f"Error loading messages: {str(e)}")
+        return [], 0
+    return messages, total or 0
+
+def load_older_messages_cloud(cursor, limit=HISTORY_PAGE_SIZE):
+    """Load a page of messages older than ``cursor`` and the cursor for the page before it"""
+    try:
+        return get_message_store().older(cursor, limit)
+    except Exception as e:
+        st.error(f"Error loading messages: {str(e)}")
+        return [], cursor
+
+def search_messages_cloud(query, users=None, start=None, end=None):
+    """Find the newest messages containing every word of ``query`` (``word*`` for prefixes)"""
+    try:
+        return get_message_store().search(query, users, start, end)
+    except Exception as e:
+        st.error(f"Error searching messages: {str(e)}")
+        return []
+
 def save_messages_cloud(messages):
-    """Save messages to GitHub Gist (cloud storage)"""
-    if not GITHUB_TOKEN or not GIST_ID:
-        # Fallback to session state for demo purposes
-        st.session_state.messages = messages
-        return True
-    
+    """Replace every stored message (cloud storage)"""
     try:
-        headers = {
-            'Authorization': f'token {GITHUB_TOKEN}',
-            'Accept': 'application/vnd.github.v3+json',
-            'Content-Type': 'application/json'
-        }
-        
-        data = {
-            'files': {
-                'messages.json': {
-                    'content': json.dumps(messages, ensure_ascii=False, indent=2)
-                }
-            }
-        }
-        
-        response = requests.patch(f'https://api.github.com/gists/{GIST_ID}', 
-                                headers=headers, 
-                                data=json.dumps(data))
-        return response.status_code == 200
+        get_message_store().replace_all(messages)
+        return True
     except Exception as e:
         st.error(f"Error saving messages: {str(e)}")
         return False
 
 def add_message_cloud(username, message):
     """Add a new message to the cloud storage"""
-    messages = load_messages_cloud()
-    new_message = {
+    message = {
         "username": username,
         "message": message,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        "timestamp": datetime.now().strftime(TIMESTAMP_FORMAT)
     }
-    messages.append(new_message)
-    save_messages_cloud(messages)
-
-def get_message_stats(messages):
-    """Get statistics about messages"""
-    if not messages:
-        return {"total": 0, "khizar": 0, "ahad": 0, "size_kb": 0}
+    # Delivery latency runs from here until the message shows up on a screen
+    shared_metrics.message_sent(message_key(message))
+    if not uses_send_queue():
+        get_message_store().append([message])
+        return
     
-    khizar_count = len([m for m in messages if m["username"] == "khizar"])
-    ahad_count = len([m for m in messages if m["username"] == "ahad"])
-    size_bytes = len(json.dumps(messages).encode('utf-8'))
+    # Written to the Gist in the background; shown to the sender straight away
+    get_send_queue(st.session_state.room).put(message)
+    # A reply is likely soon
+    get_poller(room_gist(st.session_state.room)).activity()
+
+def get_message_stats():
+    """Get statistics about messages (kept up to date by every write, so no history scan)"""
+    try:
+        stats = get_message_store().stats()
+    except Exception as e:
+        st.error(f"Error loading statistics: {str(e)}")
+        stats = new_stats()
     
     return {
-        "total": len(messages),
-        "khizar": khizar_count,
-        "ahad": ahad_count,
-        "size_kb": round(size_bytes / 1024, 2),
-        "first_message": messages[0]["timestamp"] if messages else None,
-        "last_message": messages[-1]["timestamp"] if messages else None
+        "total": stats["total"],
+        "users": stats["users"],
+        "days": stats["days"],
+        "size_kb": round(stats["bytes"] / 1024, 2),
+        "first_message": stats["first"],
+        "last_message": stats["last"]
     }
 
+def discard_export():
+    """Drop the prepared export once it has been downloaded"""
+    export = st.session_state.pop('chat_export', None)
+    if export:
+        export["file"].close()
+
+def export_panel(stats):
+    """Export controls; the file is only built when asked for"""
+    first_day = datetime.strptime(stats["first_message"][:10], "%Y-%m-%d").date() if stats["first_message"] else datetime.now().date()
+    last_day = datetime.strptime(stats["last_message"][:10], "%Y-%m-%d").date() if stats["last_message"] else datetime.now().date()
+    
+    with st.form("export_form"):
+        start = st.date_input("From:", value=first_day)
+        end = st.date_input("To:", value=last_day)
+        users = st.multiselect("Users:", room_members(), default=room_members(), format_func=user_name)
+        compress = st.checkbox("Compress (gzip)", value=True)
+        prepare = st.form_submit_button("📥 Export Chat History", type="secondary")
+    
+    if prepare:
+        discard_export()
+        try:
+            # Streams from storage into the export file, never holding the whole history
+            messages = get_message_store().stream(f"{start:%Y-%m-%d}", f"{end:%Y-%m-%d} 23:59:59")
+            st.session_state.chat_export = {
+                "file": build_export(messages, users=None if set(users) == set(room_members()) else users, compress=compress),
+                "name": f"ahadchat_{st.session_state.room}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson" + (".gz" if compress else ""),
+                "mime": "application/gzip" if compress else "application/x-ndjson"
+            }
+        except Exception as e:
+            st.error(f"Error exporting messages: {str(e)}")
+    
+    export = st.session_state.get('chat_export')
+    if export:
+        export["file"].seek(0)
+        st.download_button(
+            label="💾 Download Export",
+            data=export["file"],
+            file_name=export["name"],
+            mime=export["mime"],
+            on_click=discard_export
+        )
+        st.success("📁 Export ready for download!")
+
+def search_panel(key="search"):
+    """Search the whole history through the full-text index (``key`` keeps several panels apart)"""
+    with st.form(f"{key}_form"):
+        query = st.text_input("Search for:", placeholder="Words to find - end one with * to match its beginning")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            users = st.multiselect("From:", room_members(), default=room_members(), format_func=user_name)
+        with col2:
+            start = st.date_input("Since:", value=None)
+        with col3:
+            end = st.date_input("Until:", value=None)
+        submitted = st.form_submit_button("🔍 Search")
+    
+    if submitted:
+        st.session_state[f"{key}_results"] = search_messages_cloud(
+            query,
+            users=None if set(users) == set(room_members()) else users,
+            start=f"{start:%Y-%m-%d}" if start else None,
+            end=f"{end:%Y-%m-%d} 23:59:59" if end else None
+        ) if query.strip() else None
+    
+    results = st.session_state.get(f"{key}_results")
+    if results:
+        st.caption(f"{len(results)} newest matching message{'s' if len(results) != 1 else ''}")
+        st.markdown(render_messages(reversed(results), st.session_state.username, display_name), unsafe_allow_html=True)
+    elif results is not None:
+        st.info("No messages found")
+
+def retention_panel():
+    """Auto-cleanup settings, status and archived history"""
+    st.markdown("**Auto-cleanup Settings**")
+    if not storage_configured():
+        st.info("💡 Auto-cleanup needs cloud storage")
+        return
+    
+    engine = get_retention_engine(st.session_state.room)
+    policy = engine.policy
+    with st.form("retention_form"):
+        enabled = st.checkbox("Enable auto-cleanup", value=bool(policy))
+        max_messages = st.slider("Max messages to keep", 1000, 50000, min(max(policy.max_messages or 10000, 1000), 50000), step=1000)
+        max_age_days = st.number_input("Max age in days (0 = no limit)", min_value=0, max_value=3650, value=policy.max_age_days or 0)
+        max_kb = st.number_input("Max size in KB (0 = no limit)", min_value=0, value=(policy.max_bytes or 0) // 1024, step=100)
+        save = st.form_submit_button("💾 Save Settings")
+    if save:
+        engine.set_policy(RetentionPolicy(max_messages, max_age_days, max_kb * 1024) if enabled else RetentionPolicy())
+        st.success("✅ Auto-cleanup settings saved")
+    st.caption(
+        "Messages past a limit are moved to compressed archive segments in the background. "
+        "Settings last until the app restarts; set the RETENTION_* secrets to keep them."
+    )
+    
+    if engine.last_error:
+        st.error(f"Last cleanup failed: {engine.last_error}")
+    elif engine.last_run:
+        finished, archived = engine.last_run
+        st.write(f"**Last cleanup:** {datetime.fromtimestamp(finished).strftime(TIMESTAMP_FORMAT)}, {archived} messages archived")
+    
+    try:
+        # Listed once per server and kept up to date by its cleanups
+        names = engine.archive.names(refresh=False)
+    except Exception as e:
+        st.error(f"Error listing archives: {str(e)}")
+        return
+    if not names:
+        return
+    with st.form("archive_form"):
+        name = st.selectbox(f"Archived history ({len(names)} segments):", names, index=len(names) - 1)
+        prepare = st.form_submit_button("📥 Fetch Segment")
+    if prepare:
+        try:
+            st.session_state.archive_download = {"name": name, "data": engine.archive.read(name)}
+        except Exception as e:
+            st.error(f"Error fetching archive: {str(e)}")
+    
+    download = st.session_state.get('archive_download')
+    if download:
+        st.download_button("💾 Download Segment", data=download["data"], file_name=download["name"],
+                           mime="application/gzip", on_click=discard_archive_download)
+
+def discard_archive_download():
+    """Drop the fetched archive segment once it has been downloaded"""
+    st.session_state.pop('archive_download', None)
+
+def metrics_panel():
+    """Where this server process spends its time, with percentiles over the latest calls"""
+    def ms(seconds):
+        return round(seconds * 1000, 2) if seconds is not None else None
+    
+    rows = shared_metrics.summaries()
+    counters = {(c["name"], tuple(c["labels"].items())): c["value"] for c in shared_metrics.counters()}
+    sessions = shared_metrics.sessions()
+    
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Gist Downloaded", f"{counters.get(('gist_bytes_total', (('direction', 'received'),)), 0) / 1024:.1f} KB")
+    with col2:
+        st.metric("Gist Uploaded", f"{counters.get(('gist_bytes_total', (('direction', 'sent'),)), 0) / 1024:.1f} KB")
+    with col3:
+        st.metric("Active Sessions", len(sessions))
+    with col4:
+        delivery = next((r for r in rows if r["name"] == "delivery_seconds"), None)
+        st.metric("Delivery p90", f"{delivery['quantiles'][0.9]:.2f} s" if delivery else "-")
+    
+    timings = [
+        {
+            "Phase": r["labels"].get("phase", r["name"]),
+            "Calls": r["count"],
+            "p50 ms": ms(r["quantiles"][0.5]),
+            "p90 ms": ms(r["quantiles"][0.9]),
+            "p99 ms": ms(r["quantiles"][0.99]),
+            "Total s": round(r["sum"], 2),
+        }
+        for r in rows if r["name"] == "duration_seconds"
+    ]
+    if timings:
+        st.dataframe(timings, hide_index=True, use_container_width=True)
+    else:
+        st.info("Nothing recorded yet")
+    
+    if sessions:
+        st.write("**Reruns per session:**")
+        st.dataframe([
+            {
+                "Session": ("you " if session == st.session_state.session_id else "") + session[:8],
+                "Page": counts["page"],
+                "Message list": counts["fragment"],
+                "Last seen": datetime.fromtimestamp(counts["seen"]).strftime(TIMESTAMP_FORMAT),
+            }
+            for session, counts in sessions.items()
+        ], hide_index=True, use_container_width=True)
+    
+    requests_made = {labels: value for (name, labels), value in counters.items() if name == "gist_requests_total"}
+    if requests_made:
+        st.caption("Gist requests: " + ", ".join(
+            f"{dict(labels)['method']} {dict(labels)['status']}: {value}" for labels, value in sorted(requests_made.items())
+        ))
+    if uses_gist():
+        poller = get_poller(room_gist(st.session_state.room))
+        limit = poller.client.rate_limit
+        polling = f"Gist polled every {poller.interval:.1f} s while someone is watching"
+        if limit:
+            polling += f"; {limit['remaining']} of {limit['limit']} API requests left until {datetime.fromtimestamp(limit['reset']).strftime('%H:%M')}"
+        st.caption(polling)
+    st.caption(f"Since {datetime.fromtimestamp(shared_metrics.started).strftime(TIMESTAMP_FORMAT)}; percentiles over the last {METRIC_SAMPLES} calls of each phase")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("💾 Prometheus Text", data=shared_metrics.prometheus_text().encode("utf-8"),
+                           file_name="ahadchat_metrics.prom", mime="text/plain")
+    with col2:
+        st.download_button("💾 Structured Log", data=shared_metrics.log_lines().encode("utf-8"),
+                           file_name="ahadchat_metrics.ndjson", mime="application/x-ndjson")
+
 def admin_panel():
     """Display admin panel for Khizar"""
     st.markdown("---")
     st.markdown("## 👑 Admin Panel")
+    st.caption(f"Statistics, cleanup, export and search cover the {ROOMS[st.session_state.room]['name']} room")
     
-    messages = load_messages_cloud()
-    stats = get_message_stats(messages)
+    stats = get_message_stats()
     
     # Statistics
-    col1, col2, col3, col4 = st.columns(4)
-    with col1:
+    members = room_members()
+    columns = st.columns(len(members) + 2)
+    with columns[0]:
         st.metric("Total Messages", stats["total"])
-    with col2:
-        st.metric("Your Messages", stats["khizar"])
-    with col3:
-        st.metric("Ahad's Messages", stats["ahad"])
-    with col4:
+    for column, username in zip(columns[1:], members):
+        with column:
+            label = "Your Messages" if username == st.session_state.username else f"{user_name(username)}'s Messages"
+            st.metric(label, stats["users"].get(username, 0))
+    with columns[-1]:
         st.metric("Storage Used", f"{stats['size_kb']} KB")
     
     if stats["total"] > 0:
         st.write(f"**First message:** {stats['first_message']}")
         st.write(f"**Latest message:** {stats['last_message']}")
         
+        # Activity over the last 30 days (days are "YYYY-MM-DD", so they compare as text)
+        since = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+        recent_days = {day: count for day, count in sorted(stats["days"].items()) if day > since}
+        st.bar_chart({"Messages per day": recent_days})
+        
         # Storage warning
         if stats["size_kb"] > 500:  # Warn at 500KB
             st.warning(f"⚠️ Storage usage is getting high ({stats['size_kb']} KB). Consider cleaning up old messages.")
@@ -146,41 +456,31 @@ def admin_panel():
     with col2:
         keep_last = st.number_input("Keep last N messages:", min_value=10, max_value=1000, value=100, step=10)
         if st.button("🧹 Keep Recent Only", type="secondary"):
-            if messages and len(messages) > keep_last:
-                recent_messages = messages[-keep_last:]
+            if stats["total"] <= keep_last:
+                st.info("No cleanup needed")
+            elif storage_configured():
+                # Older messages go to the archive in the background, as auto-cleanup does
+                get_retention_engine(st.session_state.room).run_soon(RetentionPolicy(max_messages=keep_last))
+                st.success(f"✅ Archiving all but the last {keep_last} messages in the background")
+            else:
+                recent_messages, total = load_recent_messages_cloud(keep_last)
                 save_messages_cloud(recent_messages)
-                deleted_count = len(messages) - keep_last
+                deleted_count = total - len(recent_messages)
                 st.success(f"✅ Kept last {keep_last} messages, deleted {deleted_count} old messages")
                 st.rerun()
-            else:
-                st.info("No cleanup needed")
     
     with col3:
-        if st.button("📥 Export Chat History", type="secondary"):
-            if messages:
-                # Create downloadable JSON
-                chat_export = {
-                    "export_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "total_messages": len(messages),
-                    "messages": messages
-                }
-                
-                st.download_button(
-                    label="💾 Download JSON",
-                    data=json.dumps(chat_export, indent=2, ensure_ascii=False),
-                    file_name=f"ahadchat_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                    mime="application/json"
-                )
-                st.success("📁 Export ready for download!")
-            else:
-                st.info("No messages to export")
+        export_panel(stats)
+    
+    st.markdown("### 🔍 Search History")
+    search_panel("admin_search")
+    
+    with st.expander("📈 Performance"):
+        metrics_panel()
     
     # Advanced Settings
     with st.expander("⚙️ Advanced Settings"):
-        st.markdown("**Auto-cleanup Settings** (Future feature)")
-        auto_cleanup = st.checkbox("Enable auto-cleanup at 10,000 messages", disabled=True)
-        max_messages = st.slider("Max messages to keep", 1000, 50000, 10000, disabled=True)
-        st.info("💡 These features can be enabled in future updates")
+        retention_panel()
 
 def login_page():
     """Display login page"""
@@ -192,35 +492,170 @@ def login_page():
     
     with col2:
         with st.form("login_form"):
-            username = st.selectbox("Select User:", ["", "khizar", "ahad"])
+            username = st.selectbox("Select User:", [""] + list(USERS))
             password = st.text_input("Password:", type="password")
             submit = st.form_submit_button("Login", use_container_width=True)
             
             if submit:
                 if username and password:
                     if username in USERS and USERS[username]["password"] == password:
+                        if not rooms_for(ROOMS, username):
+                            st.error("❌ You are not a member of any room!")
+                            return
                         st.session_state.logged_in = True
                         st.session_state.username = username
                         st.session_state.display_name = USERS[username]["name"]
-                        st.session_state.is_admin = USERS[username]["is_admin"]
+                        st.session_state.is_admin = USERS[username].get("is_admin", False)
+                        st.session_state.room = rooms_for(ROOMS, username)[0]
                         st.rerun()
                     else:
                         st.error("❌ Invalid credentials!")
                 else:
                     st.error("❌ Please select a user and enter password!")
     
-    # Show password hints
-    with st.expander("🔑 Password Hints"):
-        st.write("**Ahad's password:** ahad123")
+    # Show password hints (for the built-in users only)
+    if USERS == DEFAULT_USERS:
+        with st.expander("🔑 Password Hints"):
+            st.write("**Ahad's password:** ahad123")
     
     # Configuration status
     with st.expander("🔧 Configuration Status"):
-        if GITHUB_TOKEN and GIST_ID:
+        if storage_configured():
             st.success("✅ Cloud storage configured - messages will persist")
         else:
             st.warning("⚠️ Using session storage - messages reset on refresh")
             st.write("To enable cloud storage, set up GitHub Gist in Streamlit secrets")
 
+def user_name(username):
+    """Someone's name (their username once they are no longer configured)"""
+    return USERS[username]["name"] if username in USERS else username
+
+def display_name(username):
+    """Name shown on someone's messages (with a crown for the admin)"""
+    name = user_name(username)
+    # Add admin crown to Khizar's messages
+    if USERS.get(username, {}).get("is_admin"):
+        name += " 👑"
+    return name
+
+def room_members():
+    """Usernames of the members of this session's room"""
+    return ROOMS[st.session_state.room]["members"]
+
+def switch_room():
+    """Show the room picked in the room selector"""
+    st.session_state.room = st.session_state.room_choice
+    for key in ['stored_messages', 'messages_checked_at', 'messages_version', 'rewritten_version',
+                'confirm_clear_all', 'search_results', 'admin_search_results']:
+        st.session_state.pop(key, None)
+    close_history()
+    discard_export()
+    discard_archive_download()
+
+def close_history():
+    """Go back to showing only the latest messages"""
+    for key in ['history_pages', 'history_cursor', 'history_html']:
+        st.session_state.pop(key, None)
+
+def history_cursor():
+    """Where the next "load older" page starts (None when nothing older is left)"""
+    if 'history_cursor' in st.session_state:
+        return st.session_state.history_cursor
+    stored = st.session_state.get('stored_messages')
+    if not stored or st.session_state.total_messages <= len(st.session_state.visible_messages):
+        return None
+    return message_id(stored[0])
+
+def load_older_page():
+    """Add the page before the oldest one on screen"""
+    page, cursor = load_older_messages_cloud(history_cursor())
+    pages = st.session_state.get('history_pages', [])
+    if page:
+        # Only the pages on screen are kept; the newest one drops off
+        pages = ([page] + pages)[:HISTORY_MAX_PAGES]
+        st.session_state.history_html = render_messages(
+            [m for p in pages for m in p], st.session_state.username, display_name
+        )
+    st.session_state.history_pages = pages
+    st.session_state.history_cursor = cursor
+
+def older_messages_area():
+    """Older messages above the latest ones, loaded a page at a time"""
+    if history_cursor() is not None:
+        st.button("⬆️ Load older messages", on_click=load_older_page)
+    
+    pages = st.session_state.get('history_pages')
+    if pages:
+        st.markdown(st.session_state.history_html, unsafe_allow_html=True)
+        if message_id(pages[-1][-1]) + 1 < message_id(st.session_state.stored_messages[0]):
+            st.caption("⋯ newer messages hidden ⋯")
+        st.button("⬇️ Back to latest", on_click=close_history)
+        st.markdown("---")
+
+@st.fragment(run_every=MESSAGE_REFRESH_INTERVAL)
+@shared_metrics.timed("rerun.message_list")
+def message_area():
+    """Display the message list, refreshing on its own when new messages arrive"""
+    shared_metrics.rerun(st.session_state.session_id, "fragment")
+    # Sends and Gist changes found by the poller bump the notifier; otherwise
+    # look again (through the shared cache) once per CLOUD_CACHE_TTL
+    store = get_message_store()
+    poller = get_poller(room_gist(st.session_state.room)) if uses_gist() else None
+    if poller:
+        poller.watch(store)
+    now = time.time()
+    stale = now - st.session_state.get('messages_checked_at', 0) >= CLOUD_CACHE_TTL
+    if stale or st.session_state.get('messages_version') != shared_notifier.version(store.key):
+        version = shared_notifier.version(store.key)
+        rewritten = shared_notifier.version(store.rewritten_key)
+        stored = st.session_state.get('stored_messages')
+        if not stored or st.session_state.get('rewritten_version') != rewritten:
+            stored, total_messages = load_recent_messages_cloud(MESSAGE_WINDOW)
+            close_history()
+        else:
+            # Keep what is already shown and fetch only the new messages
+            new_messages, total_messages = load_messages_since_cloud(message_id(stored[-1]))
+            shared_metrics.messages_shown([message_key(m) for m in new_messages])
+            stored = (stored + new_messages)[-MESSAGE_WINDOW:]
+        # A flushed message can be stored and still pending for a moment
+        stored_keys = {message_key(m) for m in stored}
+        pending_messages = [
+            m for m in pending_messages_cloud(st.session_state.username)
+            if message_key(m) not in stored_keys
+        ]
+        st.session_state.stored_messages = stored
+        st.session_state.visible_messages = (stored + pending_messages)[-MESSAGE_WINDOW:]
+        st.session_state.total_messages = total_messages + len(pending_messages)
+        st.session_state.rewritten_version = rewritten
+        st.session_state.messages_version = version
+        st.session_state.messages_checked_at = now
+        # Message bubbles are cached, so only new messages are formatted
+        st.session_state.visible_html = render_messages(
+            st.session_state.visible_messages, st.session_state.username, display_name, pending_messages
+        )
+    recent_messages = st.session_state.visible_messages
+    total_messages = st.session_state.total_messages
+    
+    # Create a container with fixed height for scrolling
+    with st.container(height=400, border=True):
+        if recent_messages:
+            older_messages_area()
+            # The whole list is one element
+            st.markdown(st.session_state.visible_html, unsafe_allow_html=True)
+        else:
+            st.markdown("### 💬 Welcome to AhadChat!")
+            st.markdown("No messages yet. Start the conversation below!")
+    
+    if poller and poller.last_error:
+        st.caption(f"⚠️ Can't reach the Gist right now, showing the last copy ({poller.last_error})")
+    
+    # Message count indicator
+    if total_messages:
+        if total_messages > len(recent_messages):
+            st.caption(f"💬 Showing last {len(recent_messages)} of {total_messages} messages")
+        else:
+            st.caption(f"💬 {total_messages} message{'s' if total_messages != 1 else ''}")
+
 def chat_page():
     """Display chat interface"""
     # Header
@@ -228,9 +663,14 @@ def chat_page():
     with col1:
         if st.button("🚪 Logout"):
             # Clear session state
-            for key in ['logged_in', 'username', 'display_name', 'is_admin', 'confirm_clear_all']:
+            for key in ['logged_in', 'username', 'display_name', 'is_admin', 'confirm_clear_all', 'stored_messages', 'messages_checked_at',
+                        'messages_version', 'rewritten_version', 'search_results', 'admin_search_results']:
                 if key in st.session_state:
                     del st.session_state[key]
+            st.session_state.room = DEFAULT_ROOM
+            close_history()
+            discard_export()
+            discard_archive_download()
             st.rerun()
     
     with col2:
@@ -238,62 +678,20 @@ def chat_page():
         if st.session_state.get('is_admin'):
             title += " 👑"
         st.title(title)
+        rooms = rooms_for(ROOMS, st.session_state.username)
+        if len(rooms) > 1:
+            st.selectbox(
+                "Room:", rooms, index=rooms.index(st.session_state.room), format_func=lambda r: ROOMS[r]["name"],
+                key="room_choice", on_change=switch_room
+            )
     
     with col3:
         if st.button("🔄 Refresh"):
+            st.session_state.pop('messages_checked_at', None)
             st.rerun()
     
-    # Auto-refresh setup
-    if 'last_refresh' not in st.session_state:
-        st.session_state.last_refresh = time.time()
-    
-    # Display messages in a clean, simple container
-    messages = load_messages_cloud()
-    
-    # Create a container with fixed height for scrolling
-    with st.container(height=400, border=True):
-        if messages:
-            # Get last 50 messages for better performance
-            recent_messages = messages[-50:] if len(messages) > 50 else messages
-            
-            for msg in recent_messages:
-                timestamp = msg["timestamp"]
-                username = msg["username"]
-                message_text = msg["message"]
-                display_name = USERS[username]["name"]
-                
-                # Add admin crown to Khizar's messages
-                if USERS[username]["is_admin"]:
-                    display_name += " 👑"
-                
-                # Create columns for better centered message layout
-                if username == st.session_state.username:
-                    # Your message (right side, but more centered)
-                    col1, col2, col3 = st.columns([1, 2, 0.2])
-                    with col2:
-                        st.markdown(f"**You** - {timestamp}")
-                        st.info(message_text)
-                else:
-                    # Other user's message (left side, but more centered)  
-                    col1, col2, col3 = st.columns([0.2, 2, 1])
-                    with col2:
-                        st.markdown(f"**{display_name}** - {timestamp}")
-                        st.success(message_text)
-                
-                # Small spacer
-                st.markdown("")
-            
-        else:
-            st.markdown("### 💬 Welcome to AhadChat!")
-            st.markdown("No messages yet. Start the conversation below!")
-    
-    # Message count indicator
-    if messages:
-        total_messages = len(messages)
-        if total_messages > 50:
-            st.caption(f"💬 Showing last 50 of {total_messages} messages")
-        else:
-            st.caption(f"💬 {total_messages} message{'s' if total_messages != 1 else ''}")
+    # Display messages (refreshes on its own without rerunning the page)
+    message_area()
     
     # Simple message input form
     st.markdown("---")
@@ -315,17 +713,15 @@ def chat_page():
         
         if send_button and new_message.strip():
             add_message_cloud(st.session_state.username, new_message.strip())
+            st.session_state.pop('messages_checked_at', None)  # Show it straight away
             st.rerun()
     
+    with st.expander("🔍 Search messages"):
+        search_panel()
+    
     # Admin Panel (only for Khizar)
     if st.session_state.get('is_admin'):
         admin_panel()
-    
-    # Auto-refresh mechanism
-    current_time = time.time()
-    if current_time - st.session_state.last_refresh > 3:  # Faster refresh for cloud
-        st.session_state.last_refresh = current_time
-        st.rerun()
 
 def main():
     """Main application function"""
@@ -338,6 +734,11 @@ def main():
         st.session_state.display_name = None
     if 'is_admin' not in st.session_state:
         st.session_state.is_admin = False
+    if 'room' not in st.session_state:
+        st.session_state.room = DEFAULT_ROOM
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    shared_metrics.rerun(st.session_state.session_id, "page")
     
     # Set page config
     st.set_page_config(
@@ -357,11 +758,19 @@ def main():
     """
     st.markdown(hide_streamlit_style, unsafe_allow_html=True)
     
+    # Auto-cleanup runs in the background whoever is logged in, for each room once someone opens it
+    if storage_configured() and st.session_state.logged_in:
+        get_retention_engine(st.session_state.room)
+    
+    if METRICS_TEXTFILE or METRICS_LOG:
+        shared_metrics.export(METRICS_TEXTFILE, METRICS_LOG)
+    
     # Route to appropriate page
-    if st.session_state.logged_in:
-        chat_page()
-    else:
-        login_page()
+    with shared_metrics.timer("rerun.page"):
+        if st.session_state.logged_in:
+            chat_page()
+        else:
+            login_page()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,280 @@
+"""Benchmark of the storage, statistics, export and render hot paths.
+
+Builds synthetic histories of growing size for each backend and times
+what a page refresh and the admin panel do with them. The apps' Streamlit
+wrappers are thin (``load_messages`` is ``store.all()``, ``add_message``
+is ``store.add`` and so on), so the store calls are timed directly:
+
+* ``load_messages`` - ``store.all()``, the whole history, parsed afresh
+  every run (the Gist store's kept segments are dropped first)
+* ``load_recent`` - the message window a refresh loads
+* ``add_message`` - one send
+* ``get_message_stats`` - the admin panel's statistics
+* ``export`` - a gzip NDJSON export of the whole history
+* ``render`` / ``render_cached`` - the message window's HTML, from a cold
+  and a warm fragment cache
+* ``search`` - one full-text query
+
+``jsonl`` is the local app's default store, ``gist`` the cloud app's
+(against ``fake_gist_server`` with sealed segments in an archive Gist)
+and ``sqlite`` is available to both.
+
+    python benchmark.py --sizes 1000,10000,100000 --output results.json
+    python benchmark.py gist --sizes 1000,10000 --latency 0.05
+    python benchmark.py --compare old.json --output new.json
+
+Results are written as JSON; ``--compare`` prints how the medians moved
+against an earlier run.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from message_cache import shared_cache
+from message_export import build_export
+from message_log import write_messages
+from message_render import render_fragment, render_messages
+from message_stats import compute_stats, write_stats_file
+from message_store import TIMESTAMP_FORMAT, JsonFileStore, SqliteStore
+
+BACKENDS = {"jsonl": "app.py", "sqlite": "app.py, app_cloud.py", "gist": "app_cloud.py"}
+DEFAULT_SIZES = "1000,10000,100000"
+MESSAGE_WINDOW = 50  # As in the apps
+SEED_BATCH_SIZE = 10000  # Messages per write when filling a store
+USERS = {"khizar": "Khizar", "ahad": "Ahad"}
+WORDS = (
+    "hey hi hello how are you doing today tomorrow yesterday lunch dinner meeting call later soon "
+    "sure thanks ok okay great nice cool see the a an and or but with for on at in to from about "
+    "work home project deploy chat message send read done busy free weekend plan trip coffee"
+).split()
+
+
+def synthetic_messages(count, seed=1):
+    """``count`` reproducible messages spread over the last year, oldest first"""
+    rng = random.Random(seed)
+    start = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / max(count, 1)
+    for n in range(count):
+        yield {
+            "id": n + 1,
+            "username": rng.choice(list(USERS)),
+            "message": " ".join(rng.choices(WORDS, k=rng.randint(2, 20))),
+            "timestamp": (start + step * n).strftime(TIMESTAMP_FORMAT),
+        }
+
+
+def batches(messages, size=SEED_BATCH_SIZE):
+    batch = []
+    for message in messages:
+        batch.append(message)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def open_jsonl(directory, count, server=None):
+    path = os.path.join(directory, "messages.jsonl")
+    write_messages(synthetic_messages(count), path)
+    store = JsonFileStore(path, legacy_path=None)
+    write_stats_file(compute_stats(synthetic_messages(count)), store.stats_path)
+    return store
+
+
+def open_sqlite(directory, count, server=None):
+    store = SqliteStore(os.path.join(directory, "messages.db"))
+    for batch in batches(synthetic_messages(count)):
+        store.append([{k: v for k, v in m.items() if k != "id"} for m in batch])
+    return store
+
+
+def open_gist(directory, count, server):
+    """A segmented Gist as the cloud app keeps it, sealed segments in an archive Gist"""
+    from gist_client import GistClient
+    from gist_format import encode, encode_messages
+    from gist_segments import MANIFEST_FILENAME, SEGMENT_SIZE, SegmentedGist, new_manifest, segment_filename
+
+    messages = list(synthetic_messages(count))
+    manifest = new_manifest(SEGMENT_SIZE)
+    archive = {}
+    sealed = len(messages) - len(messages) % SEGMENT_SIZE
+    for start in range(0, sealed, SEGMENT_SIZE):
+        chunk = messages[start:start + SEGMENT_SIZE]
+        content = encode_messages(chunk)
+        name = segment_filename(manifest["next_segment"], content)
+        manifest["next_segment"] += 1
+        manifest["segments"].append({
+            "file": name, "count": len(chunk), "first_id": chunk[0]["id"], "last_id": chunk[-1]["id"],
+            "first": chunk[0]["timestamp"], "last": chunk[-1]["timestamp"], "archived": True,
+        })
+        archive[name] = content
+    manifest["next_id"] = count + 1
+    manifest["stats"] = compute_stats(messages)
+    key = f"bench-{count}-{time.monotonic_ns()}"
+    server.store.create(key + "-archive", archive or None)
+    server.store.create(key, {
+        "messages.json": encode_messages(messages[sealed:]),
+        MANIFEST_FILENAME: encode(manifest),
+    })
+    return SegmentedGist(
+        GistClient(key, "bench", api_url=server.url),
+        GistClient(key + "-archive", "bench", api_url=server.url),
+        segment_size=SEGMENT_SIZE
+    )
+
+
+OPENERS = {"jsonl": open_jsonl, "sqlite": open_sqlite, "gist": open_gist}
+
+
+def timed(function, repeat):
+    """Milliseconds each of ``repeat`` calls took, and the last result"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        times.append((time.perf_counter() - started) * 1000)
+    return times, result
+
+
+def load_all(store):
+    # The Gist store keeps every sealed segment it has parsed, and its
+    # clients the files; drop them so each run loads what a new server
+    # process would rather than looking up the copies from the last run
+    if hasattr(store, "archive_client"):  # gist_segments.SegmentedGist, imported only for the gist backend
+        with store._lock:
+            store._segments.clear()
+        for client in (store.client, store.archive_client):
+            if client is not None:
+                with client._lock:
+                    client._parsed.clear()
+    return store.all()
+
+
+def load_recent(store):
+    # What a refresh pays after a send: the shared cache was just invalidated
+    shared_cache.invalidate(store.key)
+    return store.recent(MESSAGE_WINDOW)[0]
+
+
+def render_cold(messages):
+    render_fragment.cache_clear()
+    return render_messages(messages, "khizar", USERS.get)
+
+
+def operations(store):
+    """(name, function) pairs to time against ``store``"""
+    window = store.recent(MESSAGE_WINDOW)[0]
+    return [
+        ("load_messages", lambda: load_all(store)),
+        ("load_recent", lambda: load_recent(store)),
+        ("add_message", lambda: store.add("khizar", "benchmark message")),
+        ("get_message_stats", lambda: store.stats()),
+        ("export", lambda: build_export(store.stream(), compress=True).getbuffer().nbytes),
+        ("render", lambda: render_cold(window)),
+        ("render_cached", lambda: render_messages(window, "khizar", USERS.get)),
+        ("search", lambda: store.search("lunch meeting")),
+    ]
+
+
+def run_backend(backend, sizes, repeat, latency):
+    server = None
+    if backend == "gist":
+        from fake_gist_server import FakeGistServer
+        server = FakeGistServer(latency=latency).start()
+    results = []
+    for count in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            started = time.perf_counter()
+            store = OPENERS[backend](directory, count, server)
+            setup = time.perf_counter() - started
+            print(f"{backend} {count} messages (set up in {setup:.1f}s)", file=sys.stderr)
+            for name, function in operations(store):
+                times, result = timed(function, repeat)
+                entry = {
+                    "backend": backend,
+                    "app": BACKENDS[backend],
+                    "messages": count,
+                    "operation": name,
+                    "runs": repeat,
+                    "first_ms": round(times[0], 3),  # Cold: caches and the search index start empty
+                    "min_ms": round(min(times), 3),
+                    "median_ms": round(statistics.median(times), 3),
+                    "max_ms": round(max(times), 3),
+                }
+                if name == "export":
+                    entry["bytes"] = result
+                results.append(entry)
+                print(f"  {name:<18} {entry['median_ms']:>10.2f} ms", file=sys.stderr)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Print how each median moved from ``old`` to ``new`` (both result documents)"""
+    before = {(r["backend"], r["messages"], r["operation"]): r["median_ms"] for r in old["results"]}
+    print(f"{'backend':<8} {'messages':>9} {'operation':<18} {'before ms':>10} {'after ms':>10} {'change':>8}")
+    for r in new["results"]:
+        key = (r["backend"], r["messages"], r["operation"])
+        if key not in before:
+            continue
+        change = (r["median_ms"] / before[key] - 1) * 100 if before[key] else 0.0
+        print(f"{key[0]:<8} {key[1]:>9} {key[2]:<18} {before[key]:>10.2f} {r['median_ms']:>10.2f} {change:>+7.0f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time storage, statistics, export and render as history grows")
+    parser.add_argument("backends", nargs="*", help=f"any of {', '.join(BACKENDS)} (default: all)")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="history sizes, comma separated (up to 1000000)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per operation")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake Gist request")
+    parser.add_argument("--output", help="write the results here as JSON (default: stdout)")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    args = parser.parse_args()
+    unknown = set(args.backends) - set(BACKENDS)
+    if unknown:
+        parser.error(f"unknown backend: {', '.join(sorted(unknown))}")
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    document = {
+        "revision": git_revision(),
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"sizes": sizes, "repeat": args.repeat, "latency": args.latency},
+        "results": [],
+    }
+    for backend in args.backends or list(BACKENDS):
+        document["results"].extend(run_backend(backend, sizes, args.repeat, args.latency))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(document, f, indent=2)
+    else:
+        json.dump(document, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), document)
+
+
+if __name__ == "__main__":
+    main()
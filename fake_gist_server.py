@@ -0,0 +1,224 @@
+"""Local stand-in for the GitHub Gist API.
+
+Implements the small part of the API AhadChat uses (GET and PATCH of a
+gist, ETag revalidation, revision history and, with ``--rate-limit``, the
+``X-RateLimit-*`` headers and refusals) so the cloud version can be
+run and measured without touching GitHub. Point the app at it with the
+``GIST_API_URL`` secret:
+
+    python fake_gist_server.py --port 8765
+    # .streamlit/secrets.toml
+    GITHUB_TOKEN = "local"
+    GIST_ID = "local"
+    GIST_API_URL = "http://127.0.0.1:8765"
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGistStore:
+    """In-memory gists with a revision history"""
+
+    def __init__(self, rate_limit=None, rate_window=3600):
+        self.lock = threading.Lock()
+        self.gists = {}
+        self.requests = 0
+        self.rate_limit = rate_limit  # Requests allowed per window, None for no limit
+        self.rate_window = rate_window
+        self.rate_used = 0
+        self.rate_reset = time.time() + rate_window
+
+    def _roll_window(self):
+        if time.time() >= self.rate_reset:
+            self.rate_used = 0
+            self.rate_reset = time.time() + self.rate_window
+
+    def rate_limited(self):
+        """Whether the rate limit is used up until the window resets"""
+        with self.lock:
+            self._roll_window()
+            return self.rate_limit is not None and self.rate_used >= self.rate_limit
+
+    def rate_headers(self, charge=True):
+        """``X-RateLimit-*`` headers for a response, counting it against the limit if ``charge``"""
+        if self.rate_limit is None:
+            return {}
+        with self.lock:
+            self._roll_window()
+            if charge:
+                self.rate_used += 1
+            return {
+                "X-RateLimit-Limit": str(self.rate_limit),
+                "X-RateLimit-Remaining": str(max(self.rate_limit - self.rate_used, 0)),
+                "X-RateLimit-Reset": str(int(self.rate_reset)),
+                "X-RateLimit-Used": str(self.rate_used),
+            }
+
+    def create(self, gist_id, files=None):
+        """Create (or reset) a gist holding ``files`` (name -> text)"""
+        with self.lock:
+            self.gists[gist_id] = {"files": {}, "history": []}
+            self._commit(gist_id, files or {"messages.json": "[]"})
+
+    def _commit(self, gist_id, changes):
+        gist = self.gists[gist_id]
+        files = dict(gist["files"])
+        for name, content in changes.items():
+            if content is None:
+                files.pop(name, None)
+            else:
+                files[name] = content
+        revision = hashlib.sha1(
+            json.dumps([len(gist["history"]), files], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        gist["files"] = files
+        gist["history"].insert(0, {"version": revision, "files": files})
+
+    def update(self, gist_id, changes):
+        with self.lock:
+            self._commit(gist_id, changes)
+
+    def document(self, gist_id, revision=None):
+        """Return the API representation of a gist, optionally at an older revision"""
+        with self.lock:
+            gist = self.gists.get(gist_id)
+            if gist is None:
+                return None
+            history = gist["history"]
+            if revision is not None:
+                matching = [h for h in history if h["version"] == revision]
+                if not matching:
+                    return None
+                history = history[history.index(matching[0]):]
+            files = history[0]["files"]
+            return {
+                "id": gist_id,
+                "files": {
+                    name: {"filename": name, "content": content, "size": len(content.encode("utf-8")), "truncated": False}
+                    for name, content in files.items()
+                },
+                "history": [{"version": h["version"]} for h in history],
+            }
+
+
+class FakeGistHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None, charge=True):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        headers = {**self.server.store.rate_headers(charge), **(headers or {})}
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_empty(self, status, headers=None):
+        # As on GitHub, a 304 does not count against the rate limit
+        headers = {**self.server.store.rate_headers(status != 304), **(headers or {})}
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def _route(self):
+        """(gist ID, revision) of the request, or (None, None); a refusal for the rate limit is already sent"""
+        self.refused = False
+        with self.server.store.lock:
+            self.server.store.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.store.rate_limited():
+            self._send_json(403, {"message": "API rate limit exceeded"}, charge=False)
+            self.refused = True
+            return None, None
+        parts = [p for p in self.path.split("?")[0].split("/") if p]
+        if len(parts) < 2 or parts[0] != "gists":
+            return None, None
+        return parts[1], (parts[2] if len(parts) > 2 else None)
+
+    def do_GET(self):
+        gist_id, revision = self._route()
+        if self.refused:
+            return
+        document = self.server.store.document(gist_id, revision) if gist_id else None
+        if document is None:
+            self._send_json(404, {"message": "Not Found"})
+            return
+        etag = '"%s"' % document["history"][0]["version"]
+        if self.headers.get("If-None-Match") == etag:
+            self._send_empty(304, {"ETag": etag})
+            return
+        self._send_json(200, document, {"ETag": etag})
+
+    def do_PATCH(self):
+        gist_id, _ = self._route()
+        if self.refused:
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            self._send_json(400, {"message": "Problems parsing JSON"})
+            return
+        if not gist_id or self.server.store.document(gist_id) is None:
+            self._send_json(404, {"message": "Not Found"})
+            return
+        changes = {
+            name: info.get("content") if info is not None else None
+            for name, info in body.get("files", {}).items()
+        }
+        self.server.store.update(gist_id, changes)
+        self._send_json(200, self.server.store.document(gist_id))
+
+
+class FakeGistServer(ThreadingHTTPServer):
+    """Threaded HTTP server answering Gist API requests from a FakeGistStore"""
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, store=None):
+        super().__init__(address, FakeGistHandler)
+        self.latency = latency
+        self.store = store or FakeGistStore()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve from a background thread and return self"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the GitHub Gist API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--gist-id", default="local")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--rate-limit", type=int, help="requests allowed per window, as GitHub's 5000 an hour")
+    parser.add_argument("--rate-window", type=int, default=3600, help="seconds until the rate limit resets")
+    args = parser.parse_args()
+
+    store = FakeGistStore(args.rate_limit, args.rate_window)
+    server = FakeGistServer((args.host, args.port), latency=args.latency, store=store)
+    server.store.create(args.gist_id)
+    print(f"Fake Gist API at {server.url}/gists/{args.gist_id}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""Client for the GitHub Gist API used as AhadChat's cloud storage.
+
+A single client keeps one pooled ``requests.Session`` so polls reuse the
+same TCP/TLS connection, and it revalidates with ``If-None-Match`` so an
+unchanged Gist costs a bodyless 304 instead of a full download. The
+``X-RateLimit-*`` headers of every response are kept in ``rate_limit``,
+and a request GitHub refuses for the rate limit raises ``RateLimitError``
+with the time it resets.
+
+Request times, bytes sent and received and JSON parsing and encoding
+times are recorded in ``metrics.shared_metrics``.
+"""
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from gist_format import decode_messages, encode_messages
+from metrics import shared_metrics
+
+GITHUB_API_URL = "https://api.github.com"
+GIST_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+MESSAGES_FILENAME = "messages.json"
+
+
+class GistError(Exception):
+    """Raised when the Gist API cannot be reached or returns an error"""
+
+
+class RateLimitError(GistError):
+    """Raised when GitHub refuses requests until the rate limit resets"""
+
+    def __init__(self, message, reset_at):
+        super().__init__(message)
+        self.reset_at = reset_at  # time.time() at which requests are allowed again
+
+
+def rate_limit_headers(headers):
+    """``{"limit", "remaining", "reset"}`` from a response's ``X-RateLimit-*`` headers, or None"""
+    try:
+        return {
+            "limit": int(headers["X-RateLimit-Limit"]),
+            "remaining": int(headers["X-RateLimit-Remaining"]),
+            "reset": int(headers["X-RateLimit-Reset"]),
+        }
+    except (KeyError, ValueError):
+        return None
+
+
+class GistClient:
+    """Reads and writes message files in one Gist"""
+
+    def __init__(self, gist_id, token, api_url=GITHUB_API_URL, timeout=GIST_TIMEOUT, session=None):
+        self.gist_id = gist_id
+        self.url = f"{api_url.rstrip('/')}/gists/{gist_id}"
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=10)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            'Authorization': f'token {token}',
+            'Accept': 'application/vnd.github.v3+json'
+        })
+        self.revision = None
+        self.fetched_at = None  # time.time() of the last successful refresh
+        self.rate_limit = None  # Rate limit as of the last response that reported it
+        self._lock = threading.Lock()
+        self._etag = None
+        self._files = {}
+        self._parsed = {}
+        self._changes = set()
+
+    def _request(self, method, url, **kwargs):
+        shared_metrics.increment("gist_bytes_total", len(kwargs.get("data") or b""), direction="sent")
+        try:
+            with shared_metrics.timer(f"gist.{method.lower()}"):
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            shared_metrics.increment("gist_requests_total", method=method, status="error")
+            raise GistError(f"Gist request failed: {e}") from e
+        shared_metrics.increment("gist_requests_total", method=method, status=str(response.status_code))
+        shared_metrics.increment("gist_bytes_total", len(response.content), direction="received")
+        limit = rate_limit_headers(response.headers)
+        if limit:
+            self.rate_limit = limit
+        if response.status_code in (403, 429):
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                # Secondary rate limit: too many requests in a short time
+                raise RateLimitError("Gist rate limit exceeded", time.time() + int(retry_after))
+            if limit and limit["remaining"] == 0:
+                raise RateLimitError("Gist rate limit exceeded", limit["reset"])
+        return response
+
+    def _file_content(self, file_info):
+        if not file_info.get("truncated"):
+            return file_info["content"]
+        # Large files are cut short in the Gist response; fetch them in full
+        response = self._request("GET", file_info["raw_url"])
+        if response.status_code != 200:
+            raise GistError(f"Gist file download failed with HTTP {response.status_code}")
+        response.encoding = "utf-8"
+        return response.text
+
+    def refresh(self):
+        """Revalidate the Gist, returning the names of the files that changed since the last call (empty if none)"""
+        with self._lock:
+            etag = self._etag
+        headers = {'If-None-Match': etag} if etag else {}
+        response = self._request("GET", self.url, headers=headers)
+        if response.status_code == 304:
+            self.fetched_at = time.time()
+            return set()
+        if response.status_code != 200:
+            raise GistError(f"Gist request failed with HTTP {response.status_code}")
+
+        with shared_metrics.timer("serialize.parse"):
+            gist_data = response.json()
+        files = {
+            name: self._file_content(info)
+            for name, info in gist_data.get("files", {}).items()
+        }
+        history = gist_data.get("history") or [{}]
+        with self._lock:
+            # Files written from here are already up to date
+            changed = {name for name in files.keys() | self._files.keys() if files.get(name) != self._files.get(name)}
+            self._etag = response.headers.get("ETag")
+            self.revision = history[0].get("version")
+            self._files = files
+            self._parsed = {name: messages for name, messages in self._parsed.items() if name not in changed}
+            self._changes |= changed
+            self.fetched_at = time.time()
+        return changed
+
+    def changes(self):
+        """Names of the files any refresh found changed since the last call (for one poller to hand out)"""
+        with self._lock:
+            changes, self._changes = self._changes, set()
+        return changes
+
+    def files_at(self, revision):
+        """Return every file's text as it was at an earlier ``revision``"""
+        response = self._request("GET", f"{self.url}/{revision}")
+        if response.status_code != 200:
+            raise GistError(f"Gist revision request failed with HTTP {response.status_code}")
+        return {
+            name: self._file_content(info)
+            for name, info in response.json().get("files", {}).items()
+        }
+
+    def read_file(self, filename):
+        """Return the raw text of ``filename`` from the last refresh, or None"""
+        with self._lock:
+            return self._files.get(filename)
+
+    def file_names(self):
+        """Names of the files in the Gist as of the last refresh"""
+        with self._lock:
+            return list(self._files)
+
+    def snapshot(self, filenames, refresh=True):
+        """``(revision, {filename: text or None})`` of one revision
+
+        Read under one lock, so a refresh from another thread (the poller)
+        cannot pair the revision with files from a different one.
+        """
+        if refresh:
+            self.refresh()
+        with self._lock:
+            return self.revision, {name: self._files.get(name) for name in filenames}
+
+    def parse_messages(self, filename, content):
+        """Messages in ``content``, the text of ``filename`` from ``snapshot`` or ``read_file``
+
+        Parsed once per revision of the file: the list is reused while
+        ``filename`` still holds ``content``.
+        """
+        with self._lock:
+            if filename in self._parsed and self._files.get(filename) == content:
+                return list(self._parsed[filename])
+        with shared_metrics.timer("serialize.parse"):
+            messages = decode_messages(content) if content else []
+        with self._lock:
+            if self._files.get(filename) == content:
+                self._parsed[filename] = messages
+        return list(messages)
+
+    def load_messages(self, filename=MESSAGES_FILENAME, refresh=True):
+        """Return the messages stored in ``filename`` (as ``message_model.Message`` records)
+
+        The file may be in any format ``gist_format`` reads.
+
+        When the Gist is unchanged the previously parsed list is returned
+        without downloading or parsing anything again. With
+        ``refresh=False`` the copy from the last refresh is used.
+        """
+        _, files = self.snapshot([filename], refresh=refresh)
+        return self.parse_messages(filename, files[filename])
+
+    def write_files(self, files):
+        """Replace the text of several files in one PATCH
+
+        ``files`` maps filenames to text, or to None to delete the file.
+        Returns the Gist's revisions after the write, newest (this write)
+        first.
+        """
+        data = {'files': {
+            name: ({'content': content} if content is not None else None)
+            for name, content in files.items()
+        }}
+        with shared_metrics.timer("serialize.encode"):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        response = self._request("PATCH", self.url, headers={'Content-Type': 'application/json'}, data=body)
+        if response.status_code != 200:
+            raise GistError(f"Gist update failed with HTTP {response.status_code}")
+
+        history = response.json().get("history") or [{}]
+        with self._lock:
+            # The PATCH response carries a different ETag from GET, so the
+            # next refresh downloads once to pick up a matching one
+            self._etag = None
+            self.revision = history[0].get("version")
+            for name, content in files.items():
+                self._parsed.pop(name, None)
+                if content is None:
+                    self._files.pop(name, None)
+                else:
+                    self._files[name] = content
+        return [h.get("version") for h in history]
+
+    def save_messages(self, messages, filename=MESSAGES_FILENAME):
+        """Replace the messages stored in ``filename`` (in the current ``gist_format``)"""
+        with shared_metrics.timer("serialize.encode"):
+            content = encode_messages(messages)
+        self.write_files({filename: content})
+        with self._lock:
+            self._parsed[filename] = list(messages)
@@ -0,0 +1,99 @@
+"""Storage format of the files the cloud version keeps in its Gist.
+
+Version 1 stored plain, pretty-printed JSON: indentation and the four key
+names repeated for every message made up much of each file, and every
+send uploads the active segment and the manifest whole while every poll
+that finds a change downloads them. Version 2 files start with a header
+line naming the format version and the compression (``ahadchat/2
+zlib``), followed by the base64 text of zlib-compressed compact JSON.
+
+Message lists are rows rather than objects: the senders' names once,
+then one ``[id step, sender number, seconds step, text]`` row
+per message, IDs and times counted from the previous row. A message that
+does not fit (extra keys, no ID, a timestamp in another format) is kept
+as the object it was read as. Other documents (the manifest) are the same
+JSON, compressed.
+
+Readers tell the formats apart by the header, so a Gist written by an
+older version is read as it is and is rewritten in the current format by
+its next write.
+"""
+import base64
+import json
+import sys
+import zlib
+
+from message_model import SECOND, Message, to_message
+
+FORMAT_VERSION = 2
+FORMAT_MAGIC = "ahadchat/"
+COMPRESSION_LEVEL = 9  # Files are small, so the best compression costs little
+HEADER = f"{FORMAT_MAGIC}{FORMAT_VERSION} zlib\n"
+
+
+def is_current(content):
+    """Whether ``content`` was written in the current format"""
+    return content.startswith(HEADER)
+
+
+def encode(value):
+    """File content holding the JSON ``value``"""
+    data = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return HEADER + base64.b64encode(zlib.compress(data, COMPRESSION_LEVEL)).decode("ascii")
+
+
+def decode(content):
+    """The JSON value stored in ``content``, in any supported format"""
+    if not content.startswith(FORMAT_MAGIC):
+        # Version 1: plain JSON
+        return json.loads(content)
+    header, _, body = content.partition("\n")
+    if header + "\n" != HEADER:
+        raise ValueError(f"Unsupported Gist file format {header!r}; a newer version of the app wrote it")
+    return json.loads(zlib.decompress(base64.b64decode(body)).decode("utf-8"))
+
+
+def pack_messages(messages):
+    """Compact JSON value of ``messages``: the senders once, then one row per message"""
+    users = {}
+    rows = []
+    last_id = 0
+    last_time = 0
+    for message in map(to_message, messages):
+        if message.extra is None and message.time % SECOND == 0:
+            user = users.setdefault(message.user, len(users))
+            seconds = message.time // SECOND
+            rows.append([message.id - last_id, user, seconds - last_time, message.text])
+            last_id, last_time = message.id, seconds
+        else:
+            rows.append(message.as_dict())
+    return {"users": list(users), "rows": rows}
+
+
+def unpack_messages(value):
+    """Messages (``message_model.Message`` records) from a ``pack_messages`` value or a version 1 list"""
+    if isinstance(value, list):
+        return [to_message(m) for m in value]
+    users = [sys.intern(user) for user in value["users"]]
+    messages = []
+    last_id = 0
+    last_time = 0
+    for row in value["rows"]:
+        if isinstance(row, dict):
+            messages.append(to_message(row))
+            continue
+        id_step, user, seconds_step, text = row
+        last_id += id_step
+        last_time += seconds_step
+        messages.append(Message(last_id, users[user], text, last_time * SECOND))
+    return messages
+
+
+def encode_messages(messages):
+    """File content holding ``messages``"""
+    return encode(pack_messages(messages))
+
+
+def decode_messages(content):
+    """Messages stored in ``content``, in any supported format"""
+    return unpack_messages(decode(content))
@@ -0,0 +1,155 @@
+"""One background poll of the cloud Gist per server process.
+
+Without it every open session looked at the Gist itself whenever its
+shared copy was a few seconds old, so the requests sent to GitHub grew
+with the number of open tabs. A ``GistPoller`` thread is now the only
+reader: it revalidates the Gist (a bodyless 304 while nothing changed)
+and, when a new revision arrives, each store (chat room) whose files
+changed clears the shared cache and bumps the notifier, so every session
+picks the new messages out of the one copy fetched.
+
+Polls come every ``POLL_ACTIVE_INTERVAL`` seconds while messages are
+flowing and stretch by ``POLL_BACKOFF`` with each quiet poll up to
+``POLL_IDLE_INTERVAL``. They stop while no session is watching. The
+``X-RateLimit-*`` headers set a floor: polls are spread over what is left
+of the allowance until it resets, keeping ``POLL_RESERVE`` requests for
+sends, and after GitHub refuses a request nothing is polled until the
+reset time.
+"""
+import threading
+import time
+
+from gist_client import RateLimitError
+from metrics import shared_metrics
+
+POLL_ACTIVE_INTERVAL = 1.0  # Seconds between polls while people are chatting
+POLL_IDLE_INTERVAL = 30.0  # Longest gap between polls when nothing changes
+POLL_BACKOFF = 1.5  # Growth of the gap after each poll that found nothing new
+POLL_ERROR_BACKOFF = 60.0  # Longest wait between polls that fail
+POLL_RESERVE = 100  # Requests of the rate limit left for sending messages
+WATCH_TIMEOUT = 10.0  # Seconds without a watching session before polling pauses
+
+
+class GistPoller:
+    """Background thread refreshing ``client`` for every session of the process
+
+    The stores reading from ``client`` are ``SegmentedGist`` objects
+    created with ``polled=True``. Sessions call ``watch`` with the store
+    they show and ``activity`` when they send a message.
+    """
+
+    def __init__(self, client, active_interval=POLL_ACTIVE_INTERVAL, idle_interval=POLL_IDLE_INTERVAL,
+                 backoff=POLL_BACKOFF, reserve=POLL_RESERVE, watch_timeout=WATCH_TIMEOUT):
+        self.client = client
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.backoff = backoff
+        self.reserve = reserve
+        self.watch_timeout = watch_timeout
+        self.interval = active_interval
+        self.last_poll = None  # time.time() of the last successful poll
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stores = {}  # key -> every store seen watching, told about changes to its files
+        self._watched_at = None
+        self._polled_at = None
+        self._hold_until = 0.0  # No poll before this (rate limit or errors)
+        self._failures = 0
+        self._thread = None
+
+    def start(self):
+        """Start the background poller (once) and return self"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="gist-poller", daemon=True)
+                self._thread.start()
+        return self
+
+    def watch(self, store):
+        """Keep polling: a session is showing the messages of ``store`` (call on every refresh of the list)"""
+        now = time.monotonic()
+        with self._lock:
+            self._stores.setdefault(store.key, store)
+            paused = self._watched_at is None or now - self._watched_at > self.watch_timeout
+            self._watched_at = now
+            if paused:
+                # The copy may be old by now
+                self.interval = self.active_interval
+        if paused:
+            self._wake.set()
+
+    def activity(self):
+        """Someone sent a message: poll at the active rate again"""
+        with self._lock:
+            self.interval = self.active_interval
+        self._wake.set()
+
+    def spacing(self):
+        """Shortest gap between polls that leaves ``reserve`` requests until the rate limit resets"""
+        limit = self.client.rate_limit
+        if not limit:
+            return 0.0
+        until_reset = max(limit["reset"] - time.time(), 0.0)
+        spare = limit["remaining"] - self.reserve
+        return until_reset / spare if spare > 0 else until_reset
+
+    def poll(self):
+        """Refresh the Gist now, returning the names of the files that changed"""
+        now = time.monotonic()
+        try:
+            self.client.refresh()
+            # Also what writes found while fetching the latest revision
+            changed = self.client.changes()
+            with self._lock:
+                stores = list(self._stores.values())
+            for store in stores:
+                store.notice(changed)
+        except RateLimitError as e:
+            shared_metrics.increment("gist_polls_total", result="rate_limited")
+            with self._lock:
+                self.last_error = e
+                self._polled_at = now
+                self._hold_until = now + max(e.reset_at - time.time(), self.active_interval)
+            return set()
+        except Exception as e:
+            shared_metrics.increment("gist_polls_total", result="error")
+            with self._lock:
+                self.last_error = e
+                self._polled_at = now
+                self._failures += 1
+                self._hold_until = now + min(self.active_interval * 2 ** self._failures, POLL_ERROR_BACKOFF)
+            return set()
+        shared_metrics.increment("gist_polls_total", result="changed" if changed else "unchanged")
+        spacing = self.spacing()
+        with self._lock:
+            self.last_error = None
+            self.last_poll = time.time()
+            self._polled_at = now
+            self._failures = 0
+            self._hold_until = now + spacing
+            self.interval = self.active_interval if changed else min(self.interval * self.backoff, self.idle_interval)
+        return changed
+
+    def _delay(self):
+        """Seconds until the next poll is due, or None while no session is watching"""
+        now = time.monotonic()
+        with self._lock:
+            if self._watched_at is None or now - self._watched_at > self.watch_timeout:
+                return None
+            if self._polled_at is None:
+                return max(self._hold_until - now, 0.0)
+            return max(self._polled_at + self.interval, self._hold_until) - now
+
+    def _run(self):
+        while True:
+            delay = self._delay()
+            if delay is None:
+                self._wake.wait()
+            elif delay > 0:
+                # Woken early by a send or a returning session to look again
+                self._wake.wait(delay)
+            else:
+                self.poll()
+                continue
+            self._wake.clear()
@@ -0,0 +1,527 @@
+"""Segmented message history for the Gist backend.
+
+History is split into fixed-size segment files. Only the active segment
+(``messages.json``) changes; once it holds ``segment_size`` messages it is
+sealed into an immutable ``segment-NNNNNN-<digest>.json`` file and a fresh active
+segment starts. A small ``manifest.json`` lists the sealed segments with
+their message counts and time ranges so older history is loaded only
+when it is asked for. The manifest also carries the running statistics
+(see message_stats), updated by every write.
+
+Sealed segments can live in a separate archive Gist. Then the main Gist
+only ever holds the manifest and the active segment, and polls and sends
+cost the same however long the conversation gets. Without an archive
+Gist, sealed segments sit next to the active one: writes stay bounded
+and only the active segment is parsed, but a changed Gist is downloaded
+whole.
+
+Retention drops the sealed segments it expires whole; a segment it
+expires only part of is sealed again without that part, under a new
+name, and the active segment loses its head.
+
+Several histories (chat rooms) can share one Gist: each store's files
+start with its own ``prefix`` (``family-messages.json``,
+``family-manifest.json``, ``family-segment-...``) and it only reads,
+writes and counts those.
+
+A Gist with a plain ``messages.json`` and no manifest (the original
+layout) is read as a single active segment and split on the next write.
+Files are written in the compressed ``gist_format``; files in the older
+plain JSON are read as they are, and the next write rewrites the ones in
+the main Gist.
+
+The Gist API has no conditional writes, so appends are optimistic: a
+write whose parent in the Gist's history is not the revision it read from
+overwrote someone else's write. The writer then collects the messages
+that only the overwritten revisions held and appends them again.
+"""
+import hashlib
+import random
+import threading
+import time
+from collections import Counter
+
+from gist_client import MESSAGES_FILENAME, GistError
+from gist_format import decode, decode_messages, encode, encode_messages, is_current
+from message_log import message_id, message_key, number_messages
+from message_model import to_message
+from message_stats import add_messages, compute_stats, remove_stats
+from message_store import MessageStore, in_range
+from metrics import shared_metrics
+
+MANIFEST_FILENAME = "manifest.json"
+SEGMENT_SIZE = 1000  # Messages per sealed segment
+MAX_WRITE_ATTEMPTS = 10  # Appends retried after losing a race with another writer
+RETRY_DELAY = 0.05  # Seconds; doubles (with jitter) after every conflicting write
+RETIRED_GRACE = 300  # Seconds a segment retention replaced stays readable for writes that started before
+
+
+def segment_filename(number, content, prefix=""):
+    # The digest keeps two writers that seal at the same time from sharing a name
+    digest = hashlib.sha1(content.encode("utf-8")).hexdigest()[:8]
+    return f"{prefix}segment-{number:06d}-{digest}.json"
+
+
+def overwritten_revisions(revisions, base):
+    """Revisions other writers made between reading ``base`` and the write that returned ``revisions``"""
+    previous = revisions[1:]
+    return previous[:previous.index(base)] if base in previous else previous[:1]
+
+
+def new_manifest(segment_size=SEGMENT_SIZE):
+    return {"version": 1, "segment_size": segment_size, "next_segment": 1, "next_id": 1, "segments": []}
+
+
+class SegmentedGist(MessageStore):
+    """Message history stored as sealed segments plus one active segment
+
+    The Gist cannot say cheaply whether it changed, so either cached copies
+    expire after ``cache_max_age`` seconds or, with ``polled``, a
+    ``gist_poller.GistPoller`` refreshes the client and calls ``notice``,
+    and reads use the copy it fetched last. Writes always fetch the latest
+    revision first.
+    """
+
+    def __init__(self, client, archive_client=None, segment_size=SEGMENT_SIZE, cache_max_age=None, polled=False,
+                 prefix=""):
+        super().__init__(f"{client.gist_id}/{prefix}" if prefix else client.gist_id, cache_max_age=cache_max_age)
+        self.client = client
+        self.polled = polled
+        self.prefix = prefix
+        self.messages_file = prefix + MESSAGES_FILENAME
+        self.manifest_file = prefix + MANIFEST_FILENAME
+        self.archive_client = archive_client
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # One write at a time from this process
+        self._legacy_stats = (None, None)
+        self._segments = {}  # Sealed segments never change, so keep them once loaded
+
+    def _segments_with_ids(self, manifest):
+        """(segment, first message ID) pairs, oldest first"""
+        pairs = []
+        next_id = 1
+        for segment in manifest["segments"]:
+            # Segments sealed before IDs existed were numbered from 1 without gaps
+            first_id = segment.get("first_id", next_id)
+            pairs.append((segment, first_id))
+            next_id = segment.get("last_id", first_id + segment["count"] - 1) + 1
+        return pairs, next_id
+
+    def notice(self, changed_files):
+        """Tell every session if a refresh of the Gist (by a poller) changed this store's files"""
+        if self.messages_file in changed_files or self.manifest_file in changed_files:
+            self._changed()
+            return True
+        return False
+
+    def _read(self, fresh=False):
+        """Revision, manifest and active segment of one fetch (the poller's latest unless ``fresh``)
+
+        Taken from the client together: the poller refreshes the same
+        client, and a write whose base revision is newer than what it read
+        would not see the writes it overwrites.
+        """
+        refresh = fresh or not self.polled or self.client.fetched_at is None
+        revision, files = self.client.snapshot([self.manifest_file, self.messages_file], refresh=refresh)
+        content = files[self.manifest_file]
+        manifest = decode(content) if content else new_manifest(self.segment_size)
+        active = self.client.parse_messages(self.messages_file, files[self.messages_file])
+        _, next_id = self._segments_with_ids(manifest)
+        manifest["next_id"] = max(manifest.get("next_id", 1), number_messages(active, next_id))
+        return revision, manifest, active
+
+    def _snapshot(self, fresh=False):
+        """Manifest and active segment of one fetch (see ``_read``)"""
+        _, manifest, active = self._read(fresh)
+        return manifest, active
+
+    def load_segment(self, segment, first_id=1, cache=True):
+        """Messages of one sealed segment from the manifest"""
+        name = segment["file"]
+        with self._lock:
+            if name in self._segments:
+                return self._segments[name]
+        if segment.get("archived"):
+            if self.archive_client is None:
+                raise GistError(f"{name} is in the archive Gist, which is not configured")
+            messages = self.archive_client.load_messages(name)
+        else:
+            messages = self.client.load_messages(name, refresh=False)
+        number_messages(messages, segment.get("first_id", first_id))
+        if cache:
+            with self._lock:
+                self._segments[name] = messages
+        return messages
+
+    def _recent(self, limit):
+        """The last ``limit`` messages and the total number stored
+
+        Sealed segments are only read when the active one holds fewer than
+        ``limit`` messages.
+        """
+        manifest, messages = self._snapshot()
+        total = len(messages) + sum(s["count"] for s in manifest["segments"])
+        segments, _ = self._segments_with_ids(manifest)
+        for segment, first_id in reversed(segments):
+            if len(messages) >= limit:
+                break
+            messages = self.load_segment(segment, first_id) + messages
+        return (messages[-limit:] if limit > 0 else []), total
+
+    def _since(self, since_id):
+        """The messages with an ID greater than ``since_id``, oldest first
+
+        Sealed segments are only read when the new messages reach back past
+        the start of the active segment.
+        """
+        manifest, active = self._snapshot()
+        messages = [m for m in active if message_id(m) > since_id]
+        segments, _ = self._segments_with_ids(manifest)
+        for segment, first_id in reversed(segments):
+            if segment.get("last_id", first_id + segment["count"] - 1) <= since_id:
+                break
+            messages = [m for m in self.load_segment(segment, first_id) if message_id(m) > since_id] + messages
+        return messages
+
+    def _before(self, before_id, limit):
+        """Up to ``limit`` messages older than ``before_id``, reading back only as many segments as needed"""
+        manifest, active = self._snapshot()
+        messages = [m for m in active if message_id(m) < before_id]
+        segments, _ = self._segments_with_ids(manifest)
+        for segment, first_id in reversed(segments):
+            if len(messages) >= limit:
+                break
+            if first_id >= before_id:
+                continue
+            messages = [m for m in self.load_segment(segment, first_id) if message_id(m) < before_id] + messages
+        return messages[-limit:] if limit > 0 else []
+
+    def _messages(self, manifest, active):
+        messages = []
+        segments, _ = self._segments_with_ids(manifest)
+        for segment, first_id in segments:
+            messages.extend(self.load_segment(segment, first_id))
+        messages.extend(active)
+        return messages
+
+    def _all(self):
+        return self._messages(*self._snapshot())
+
+    def _stream(self, start, end):
+        """Segments whose time range misses ``start``..``end`` are not downloaded"""
+        manifest, active = self._snapshot()
+        segments, _ = self._segments_with_ids(manifest)
+        for segment, first_id in segments:
+            if start is not None and segment.get("last") and segment["last"] < start:
+                continue
+            if end is not None and segment.get("first") and segment["first"] > end:
+                continue
+            # Not cached, so an export of a long history does not stay in memory
+            yield from in_range(self.load_segment(segment, first_id, cache=False), start, end)
+        yield from in_range(active, start, end)
+
+    def _get(self, ids, index):
+        """Only the segments whose ID range holds one of ``ids`` are loaded"""
+        wanted = set(ids)
+        manifest, active = self._snapshot()
+        segments, _ = self._segments_with_ids(manifest)
+        found = [m for m in active if message_id(m) in wanted]
+        for segment, first_id in segments:
+            last_id = segment.get("last_id", first_id + segment["count"] - 1)
+            if any(first_id <= doc <= last_id for doc in wanted):
+                found.extend(m for m in self.load_segment(segment, first_id) if message_id(m) in wanted)
+        return found
+
+    def _manifest_stats(self, manifest, active):
+        if "stats" not in manifest:
+            # Written before statistics were kept: count once, saved with the next write
+            manifest["stats"] = compute_stats(self._messages(manifest, active))
+        return manifest["stats"]
+
+    def _stats(self):
+        revision, manifest, active = self._read()
+        if "stats" not in manifest:
+            # Until the next write saves them, count once per revision
+            if self._legacy_stats[0] != revision:
+                self._legacy_stats = revision, self._manifest_stats(manifest, active)
+            return self._legacy_stats[1]
+        return manifest["stats"]
+
+    def _new_segment(self, manifest, chunk):
+        """Seal ``chunk`` under the next segment number, returning (manifest entry, file content)"""
+        with shared_metrics.timer("serialize.encode"):
+            content = encode_messages(chunk)
+        name = segment_filename(manifest["next_segment"], content, self.prefix)
+        manifest["next_segment"] += 1
+        with self._lock:
+            self._segments[name] = [to_message(m) for m in chunk]
+        segment = {
+            "file": name,
+            "count": len(chunk),
+            "first_id": message_id(chunk[0]),
+            "last_id": message_id(chunk[-1]),
+            "first": chunk[0].get("timestamp"),
+            "last": chunk[-1].get("timestamp"),
+            "archived": self.archive_client is not None,
+        }
+        return segment, content
+
+    def _seal(self, manifest, active):
+        """Move full segments out of ``active``, returning (sealed files, rest of active)"""
+        sealed = {}
+        while len(active) >= self.segment_size:
+            chunk, active = active[:self.segment_size], active[self.segment_size:]
+            segment, content = self._new_segment(manifest, chunk)
+            manifest["segments"].append(segment)
+            sealed[segment["file"]] = content
+        return sealed, active
+
+    def _write(self, manifest, active, removed=(), added=None):
+        """Write the manifest and active segment, returning the Gist's revisions, newest first
+
+        ``removed`` are sealed segments to delete and ``added`` the files of
+        sealed segments the manifest gained besides those sealed here.
+        """
+        sealed, active = self._seal(manifest, active)
+        sealed.update(added or {})
+        with shared_metrics.timer("serialize.encode"):
+            files = {
+                self.messages_file: encode_messages(active),
+                self.manifest_file: encode(manifest),
+            }
+            files.update(self._migrated(manifest))
+        files.update({s["file"]: None for s in removed if not s.get("archived")})
+        if self.archive_client is None:
+            files.update(sealed)
+        elif sealed:
+            # Archived first so the manifest never lists a segment that is missing
+            self.archive_client.write_files(sealed)
+        revisions = self.client.write_files(files)
+
+        archived_removed = [s["file"] for s in removed if s.get("archived")]
+        if archived_removed:
+            self.archive_client.write_files({name: None for name in archived_removed})
+        return revisions
+
+    def _migrated(self, manifest):
+        """Sealed segments in the main Gist still in the older format, rewritten in the current one
+
+        Only their encoding changes, so their names and messages stay valid.
+        """
+        files = {}
+        for segment in manifest["segments"]:
+            content = None if segment.get("archived") else self.client.read_file(segment["file"])
+            if content and not is_current(content):
+                files[segment["file"]] = encode_messages(decode_messages(content))
+        return files
+
+    def _read_state(self, read_file):
+        """Manifest and active segment of a revision, ``read_file`` returning the text of its files"""
+        content = read_file(self.manifest_file)
+        manifest = decode(content) if content else new_manifest(self.segment_size)
+        return manifest, decode_messages(read_file(self.messages_file) or "[]")
+
+    def _tail(self, segments, active, shared, read_file):
+        """Messages in ``active`` and in the ``segments`` not named in ``shared``"""
+        messages = []
+        for segment in segments:
+            if segment["file"] in shared:
+                continue
+            if segment.get("archived"):
+                if self.archive_client is not None:
+                    messages.extend(self.archive_client.load_messages(segment["file"]))
+            else:
+                messages.extend(decode_messages(read_file(segment["file"]) or "[]"))
+        return messages + list(active)
+
+    def _lost_messages(self, revisions, segments, written, expired_before=0):
+        """Messages stored in the overwritten ``revisions`` (newest first) but not in what we wrote
+
+        ``segments`` and ``written`` are the sealed segments and the active
+        messages our write started from. Sealed segments both sides list
+        are the same, so only the rest is compared. Messages are matched on
+        sender, time and text, counting repeats, and come back without IDs,
+        oldest first.
+
+        Returns the lost messages and the highest ``expired_before`` of
+        our write and the overwritten revisions. Messages below it were
+        archived by retention, so a revision that still holds them is not
+        putting them back.
+        """
+        ours = {s["file"] for s in segments}
+        lost = []
+        found = Counter()
+        states = []
+        for revision in reversed(revisions):
+            read_file = self.client.files_at(revision).get
+            manifest, active = self._read_state(read_file)
+            expired_before = max(expired_before, manifest.get("expired_before", 0))
+            states.append((read_file, manifest, active))
+        for read_file, manifest, active in states:
+            shared = ours & {s["file"] for s in manifest["segments"]}
+            kept = Counter(message_key(m) for m in self._tail(segments, written, shared, self.client.read_file))
+            kept.update(found)
+            seen = Counter()
+            for message in self._tail(manifest["segments"], active, shared, read_file):
+                if message_id(message) < expired_before:
+                    continue
+                key = message_key(message)
+                seen[key] += 1
+                if seen[key] > kept[key]:
+                    kept[key] += 1
+                    found[key] += 1
+                    lost.append({k: v for k, v in message.items() if k != "id"})
+        return lost, expired_before
+
+    def _append(self, batch, known=None):
+        """Append messages under new sequence IDs, touching only the active segment and the manifest
+
+        ``known`` marks ``batch`` as messages our write overwrote: the names
+        of the sealed segments that write started from, so that messages
+        another writer has put back since are not stored twice.
+        """
+        stored, expired_before = self._merged_append(batch, known)
+        if expired_before:
+            # Our write undid an expiry it raced with (the messages are archived already)
+            self._drop_before(expired_before)
+        return stored
+
+    def _merged_append(self, batch, known=None):
+        """``_append``, returning the stored messages and the ID to expire again before (0 if none)"""
+        stored = None
+        undone = 0
+        with self._write_lock:
+            for attempt in range(MAX_WRITE_ATTEMPTS):
+                base, manifest, active = self._read(fresh=True)
+                segments = list(manifest["segments"])
+                if known is not None:
+                    # Recovered messages that another writer has put back already
+                    present = Counter(message_key(m) for m in self._tail(segments, active, known, self.client.read_file))
+                    missing = []
+                    for message in batch:
+                        key = message_key(message)
+                        if present[key]:
+                            present[key] -= 1
+                        else:
+                            missing.append(message)
+                    batch = missing
+                    if not batch:
+                        return stored or [], undone
+
+                delta = [{"id": manifest["next_id"] + i, **message} for i, message in enumerate(batch)]
+                manifest["next_id"] += len(delta)
+                add_messages(self._manifest_stats(manifest, active), delta)
+                revisions = self._write(manifest, active + delta)
+                if stored is None:
+                    stored = delta
+                if known is None:
+                    known = {s["file"] for s in segments}
+
+                overwritten = overwritten_revisions(revisions, base)
+                if not overwritten:
+                    return stored, undone
+                # Whoever overwrites a write puts its messages back
+                written_before = manifest.get("expired_before", 0)
+                batch, expired_before = self._lost_messages(overwritten, segments, active + delta, written_before)
+                if expired_before > written_before:
+                    undone = max(undone, expired_before)
+                if not batch:
+                    return stored, undone
+                self._changed(rewritten=True)
+                time.sleep(random.uniform(0, RETRY_DELAY * 2 ** attempt))
+        raise GistError(f"Gave up restoring overwritten messages after {MAX_WRITE_ATTEMPTS} conflicting writes")
+
+    def _replace_all(self, messages):
+        """Replace the whole history, deleting every existing segment
+
+        A rewrite is not merged with writes it races with; the last one wins.
+        """
+        with self._write_lock:
+            manifest, _ = self._snapshot(fresh=True)
+            # IDs keep counting up so a client's last seen ID never goes backwards
+            manifest["next_id"] = number_messages(messages, manifest["next_id"])
+            manifest["stats"] = compute_stats(messages)
+            removed = manifest["segments"] + manifest.pop("retired", [])
+            # Keep counting up so a segment name never refers to different content
+            manifest["segments"] = []
+            self._write(manifest, messages, removed)
+
+    def _drop_before(self, before_id):
+        """Drop the messages older than ``before_id``
+
+        Sealed segments entirely older go whole; their statistics are
+        counted before taking the write lock, so sends from this process
+        wait only for the write. A sealed segment the cut falls in is
+        sealed again, minus its head, under a new name, and the head of
+        the active segment is cut off.
+
+        The files of the segments taken out of the manifest are only
+        listed as ``retired`` and deleted by an expiry at least
+        ``RETIRED_GRACE`` seconds later: a send that read the manifest
+        before this write may still list them, and its messages must stay
+        readable until it has been merged.
+        """
+        manifest, _ = self._snapshot()
+        segments, _ = self._segments_with_ids(manifest)
+        counted = {}
+        for segment, first_id in segments:
+            if segment.get("last_id", first_id + segment["count"] - 1) >= before_id:
+                break
+            counted[segment["file"]] = compute_stats(self.load_segment(segment, first_id, cache=False))
+
+        with self._write_lock:
+            base, manifest, active = self._read(fresh=True)
+            segments = list(manifest["segments"])
+            stats = self._manifest_stats(manifest, active)
+            dropped, kept, added, removed = [], [], {}, []
+            for segment, first_id in self._segments_with_ids(manifest)[0]:
+                last_id = segment.get("last_id", first_id + segment["count"] - 1)
+                if first_id >= before_id:
+                    # Segments from before IDs were numbered by position; pin their IDs
+                    kept.append({"first_id": first_id, "last_id": last_id, **segment})
+                    continue
+                dropped.append(segment)
+                if last_id < before_id:
+                    # Sealed by a write since the statistics were counted
+                    removed.append(counted.get(segment["file"]) or compute_stats(self.load_segment(segment, first_id, cache=False)))
+                    continue
+                messages = self.load_segment(segment, first_id, cache=False)
+                rest = [m for m in messages if message_id(m) >= before_id]
+                removed.append(compute_stats(m for m in messages if message_id(m) < before_id))
+                if rest:
+                    resealed, content = self._new_segment(manifest, rest)
+                    added[resealed["file"]] = content
+                    kept.append(resealed)
+            head = [m for m in active if message_id(m) < before_id]
+            remaining = active[len(head):]
+            if not dropped and not head:
+                return 0
+            if head:
+                removed.append(compute_stats(head))
+            manifest["segments"] = kept
+            manifest["expired_before"] = max(manifest.get("expired_before", 0), before_id)
+            first = kept[0].get("first") if kept else (remaining[0].get("timestamp") if remaining else None)
+            for counts in removed:
+                remove_stats(stats, counts, first)
+            now = time.time()
+            retired = manifest.get("retired", [])
+            expired = [s for s in retired if now - s["retired_at"] >= RETIRED_GRACE]
+            manifest["retired"] = [s for s in retired if s not in expired] + [
+                {"file": s["file"], "archived": s.get("archived", False), "retired_at": now} for s in dropped
+            ]
+            revisions = self._write(manifest, remaining, expired, added)
+            with self._lock:
+                for segment in dropped:
+                    self._segments.pop(segment["file"], None)
+            # Sends that this write overwrote go back in
+            overwritten = overwritten_revisions(revisions, base)
+            lost, expired_before = (
+                self._lost_messages(overwritten, segments, active, manifest["expired_before"]) if overwritten else ([], 0)
+            )
+        if lost:
+            self._append(lost, {s["file"] for s in segments})
+        if expired_before > manifest["expired_before"]:
+            # Another server's expiry went further
+            self._drop_before(expired_before)
+        return sum(counts["total"] for counts in removed)
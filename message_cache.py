@@ -0,0 +1,85 @@
+"""Process-wide cache of parsed messages shared by every chat session.
+
+Streamlit re-executes the app script on every rerun, but imported modules
+stay loaded, so the cache kept here is shared by all sessions served by
+the same process. With several tabs open the history is parsed once per
+change instead of once per tab per refresh.
+"""
+import threading
+import time
+
+CACHE_MAX_MESSAGES = 500  # Most messages kept per cache entry
+
+
+class MessageCache:
+    """Recent messages per storage key, reused while the storage version matches"""
+
+    def __init__(self, max_messages=CACHE_MAX_MESSAGES):
+        self.max_messages = max_messages
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._entries = {}
+        self._generations = {}
+
+    def _lookup(self, key, version, max_age):
+        entry = self._entries.get(key)
+        if entry is None or entry["version"] != version:
+            return None
+        if max_age is not None and time.monotonic() - entry["loaded_at"] > max_age:
+            return None
+        return entry
+
+    def get(self, key, version, loader, max_age=None):
+        """Return ``(messages, total)`` for ``key``, calling ``loader`` on a miss
+
+        An entry is reused while it was stored for ``version`` and, when
+        ``max_age`` is given, is younger than ``max_age`` seconds.
+        ``loader()`` returns ``(messages, total)`` where ``total`` is the
+        number of messages in storage (None if unknown); the cache keeps at
+        most ``max_messages`` of the newest messages. Only one caller loads
+        a key at a time, the others wait and reuse its result. Exceptions
+        from the loader propagate and nothing is cached.
+        """
+        with self._lock:
+            entry = self._lookup(key, version, max_age)
+            if entry is not None:
+                self.hits += 1
+                return entry["messages"], entry["total"]
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        with load_lock:
+            # Another session may have loaded it while we waited
+            with self._lock:
+                entry = self._lookup(key, version, max_age)
+                if entry is not None:
+                    self.hits += 1
+                    return entry["messages"], entry["total"]
+                self.misses += 1
+                generation = self._generations.get(key, 0)
+
+            messages, total = loader()
+            entry = {
+                "version": version,
+                "messages": messages[-self.max_messages:],
+                "total": total,
+                "loaded_at": time.monotonic(),
+            }
+            with self._lock:
+                # Skip storing data that a write invalidated while we were loading
+                if self._generations.get(key, 0) == generation:
+                    self._entries[key] = entry
+            return entry["messages"], entry["total"]
+
+    def invalidate(self, key=None):
+        """Drop the entry for ``key``, or every entry when no key is given"""
+        with self._lock:
+            keys = list(self._entries) if key is None else [key]
+            for k in keys:
+                self._entries.pop(k, None)
+                self._generations[k] = self._generations.get(k, 0) + 1
+
+
+# Shared by every session in this process
+shared_cache = MessageCache()
@@ -0,0 +1,63 @@
+"""Streaming chat export.
+
+Messages flow from the store through generators into the export file one
+at a time, as newline-delimited JSON (one message per line), optionally
+gzip-compressed on the fly. Only the finished export is kept in memory
+(Streamlit's download button needs it whole), never the history itself
+or a second serialised copy of it.
+"""
+import io
+import zlib
+
+from message_log import encode_message
+
+EXPORT_CHUNK_SIZE = 64 * 1024  # Bytes handed on at a time
+
+
+def filter_messages(messages, users=None):
+    """Messages sent by one of ``users`` (all messages if None)"""
+    if users is None:
+        return iter(messages)
+    users = set(users)
+    return (m for m in messages if m.get("username") in users)
+
+
+def ndjson_chunks(messages, chunk_size=EXPORT_CHUNK_SIZE):
+    """Encode messages as NDJSON, yielding chunks of about ``chunk_size`` bytes"""
+    buffer = []
+    size = 0
+    for message in messages:
+        line = encode_message(message).encode("utf-8")
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def gzip_chunks(chunks):
+    """Gzip-compress a stream of byte chunks"""
+    compressor = zlib.compressobj(wbits=31)  # 31: gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(messages, users=None, compress=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """The export file for ``messages`` as a stream of byte chunks"""
+    chunks = ndjson_chunks(filter_messages(messages, users), chunk_size)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def build_export(messages, users=None, compress=False):
+    """Build an export file in memory and return it, rewound"""
+    export_file = io.BytesIO()
+    for chunk in export_chunks(messages, users, compress):
+        export_file.write(chunk)
+    export_file.seek(0)
+    return export_file
@@ -0,0 +1,363 @@
+"""Append-only message log for AhadChat.
+
+Messages are stored one JSON object per line (newline-delimited JSON), so
+sending a message appends a single line instead of rewriting the whole
+history.
+
+Writers take an exclusive lock on ``<log>.lock`` (``flock`` on POSIX,
+``msvcrt.locking`` on Windows), so sessions in different processes cannot
+hand out the same ID or append to a log that is being replaced.
+Rewrites go to a temporary file that is renamed over the log.
+
+Messages are read as compact ``message_model.Message`` records.
+"""
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from json.encoder import encode_basestring
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from message_model import Message, format_timestamp, plain, to_message
+
+LEGACY_MESSAGES_FILE = "messages.json"
+MESSAGES_LOG = "messages.jsonl"
+
+# How much of the log to read per step when scanning backwards
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# Serialises writers within this process; the lock file covers other processes
+_append_lock = threading.RLock()
+_held_locks = threading.local()
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            # LK_LOCK gives up after about ten seconds; keep waiting
+            time.sleep(0.01)
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def log_lock(path=MESSAGES_LOG):
+    """Hold the log's write lock, shared by every thread and process
+
+    A thread that already holds the lock can take it again.
+    """
+    with _append_lock:
+        held = _held_locks.__dict__.setdefault("paths", set())
+        if path in held:
+            yield
+            return
+        with open(path + ".lock", "a+b") as f:
+            _lock_file(f)
+            held.add(path)
+            try:
+                yield
+            finally:
+                held.discard(path)
+                _unlock_file(f)
+
+
+def encode_message(message):
+    """Encode a message as a single log line"""
+    if type(message) is Message and message.extra is None:
+        # The text json.dumps would write, without building a dict first
+        return (
+            f'{{"id":{message.id},"username":{encode_basestring(message.user)},'
+            f'"message":{encode_basestring(message.text)},"timestamp":"{format_timestamp(message.time)}"}}\n'
+        )
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"), default=plain) + "\n"
+
+
+def decode_line(line):
+    """Decode a log line, returning None for blank or damaged lines"""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        message = json.loads(line)
+    except ValueError:
+        # A write interrupted half way leaves a partial line behind
+        return None
+    return to_message(message) if isinstance(message, dict) else message
+
+
+def log_version(path=MESSAGES_LOG):
+    """Return a value that changes whenever the log is written, or None if missing"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def message_id(message):
+    """Sequence ID of a message (0 for messages stored before IDs existed)"""
+    return message.get("id", 0)
+
+
+def message_key(message):
+    """What identifies a message apart from its ID"""
+    return (message.get("username"), message.get("timestamp"), message.get("message"))
+
+
+def number_messages(messages, next_id=1):
+    """Give every message without an ID the next sequence number, in order
+
+    Returns the ID the next new message should get.
+    """
+    for message in messages:
+        if "id" not in message:
+            message["id"] = next_id
+        next_id = max(next_id, message["id"] + 1)
+    return next_id
+
+
+def append_lines(data, path=MESSAGES_LOG):
+    """Append whole encoded lines to ``path`` in one write (callers keep other writers out)
+
+    A write interrupted half way leaves a partial last line behind; it is
+    ended first, so it stays one damaged line that readers skip instead
+    of swallowing the first line appended after it.
+    """
+    with open(path, "a+b") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size:
+            f.seek(size - 1)
+            if f.read(1) != b"\n":
+                data = b"\n" + data
+        f.write(data)
+
+
+def append_message(message, path=MESSAGES_LOG):
+    """Append one message to the end of the log"""
+    append_lines(encode_message(message).encode("utf-8"), path)
+
+
+def append_new_messages(messages, path=MESSAGES_LOG):
+    """Append messages under the next sequence IDs and return the stored copies"""
+    with log_lock(path):
+        last = read_last_messages(1, path)
+        next_id = message_id(last[0]) + 1 if last else 1
+        stored = [{"id": next_id + i, **message} for i, message in enumerate(messages)]
+        # One write, so a batch lands in the log as a whole
+        append_lines("".join(encode_message(message) for message in stored).encode("utf-8"), path)
+    return stored
+
+
+def iter_messages(path=MESSAGES_LOG):
+    """Yield the messages in the log oldest first, one line at a time"""
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            message = decode_line(line)
+            if message is not None:
+                yield message
+
+
+def read_messages(path=MESSAGES_LOG):
+    """Read the whole log as a list of message dicts"""
+    return list(iter_messages(path))
+
+
+def iter_lines(path=MESSAGES_LOG, start=0):
+    """Yield ``(offset, line)`` pairs oldest first, from byte ``start`` (the start of a line)"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        f.seek(start)
+        offset = start
+        for line in f:
+            yield offset, line
+            offset += len(line)
+
+
+def iter_lines_reversed(path=MESSAGES_LOG, end=None):
+    """Yield ``(offset, line)`` pairs newest first, reading the log backwards block by block
+
+    Scanning starts at byte ``end`` (the start of a line) or at the end of
+    the log. Only the blocks holding the lines actually consumed are read,
+    so stopping early costs what was read rather than the whole history.
+    """
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb") as f:
+        position = f.seek(0, os.SEEK_END) if end is None else end
+        remainder = b""
+        while position > 0:
+            size = min(TAIL_BLOCK_SIZE, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + remainder).split(b"\n")
+            offsets = list(itertools.accumulate((len(line) + 1 for line in lines[:-1]), initial=position))
+            # The first piece may be the tail of a line that starts in an earlier block
+            if position > 0:
+                remainder = lines.pop(0)
+                offsets.pop(0)
+            else:
+                remainder = b""
+            yield from zip(reversed(offsets), reversed(lines))
+
+
+def iter_messages_reversed(path=MESSAGES_LOG):
+    """Yield messages newest first, reading the log backwards (see ``iter_lines_reversed``)"""
+    for _, line in iter_lines_reversed(path):
+        message = decode_line(line)
+        if message is not None:
+            yield message
+
+
+def read_last_messages(limit, path=MESSAGES_LOG):
+    """Read the last ``limit`` messages, scanning backwards from the end"""
+    if limit <= 0:
+        return []
+    found = list(itertools.islice(iter_messages_reversed(path), limit))
+    found.reverse()
+    return found
+
+
+def read_messages_since(since_id, path=MESSAGES_LOG):
+    """Read the messages with an ID greater than ``since_id``, oldest first
+
+    The scan stops at the first older message, so the cost depends on how
+    many messages are new rather than on the size of the history.
+    """
+    found = list(itertools.takewhile(lambda m: message_id(m) > since_id, iter_messages_reversed(path)))
+    found.reverse()
+    return found
+
+
+def read_messages_before(before_id, limit, path=MESSAGES_LOG):
+    """Read up to ``limit`` messages with an ID lower than ``before_id``, oldest first"""
+    return read_page_before(before_id, limit, path)[0]
+
+
+def read_page_before(before_id, limit, path=MESSAGES_LOG, offset=None):
+    """Read up to ``limit`` messages older than ``before_id``, oldest first
+
+    Returns the messages and the byte offset of the first one. Passing
+    that offset back with the first message's ID reads the next page
+    from there, so paging back costs one page however deep it goes. An
+    offset that no longer points at that message (the log was rewritten)
+    is ignored.
+    """
+    if limit <= 0:
+        return [], None
+    if offset is not None:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            message = decode_line(f.readline())
+        if message is None or message_id(message) != before_id:
+            offset = None
+
+    found = []
+    first_offset = None
+    for start, line in iter_lines_reversed(path, offset):
+        message = decode_line(line)
+        if message is None or message_id(message) >= before_id:
+            continue
+        found.append(message)
+        first_offset = start
+        if len(found) >= limit:
+            break
+    found.reverse()
+    return found, first_offset
+
+
+@contextmanager
+def atomic_write(path, mode="w", sync=True):
+    """Open a temporary file that replaces ``path`` when the block ends
+
+    Readers see either the old file or the new one, never a mix. If the
+    block raises, ``path`` is left as it was. With ``sync`` the new file
+    is flushed to disk before it replaces the old one; files rebuilt when
+    lost (statistics, indexes) skip that.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, mode, encoding=None if "b" in mode else "utf-8") as f:
+            yield f
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_messages(messages, path=MESSAGES_LOG):
+    """Replace the log with the given messages
+
+    Readers see either the old log or the new one, never a mix. Callers
+    that may race with other writers hold ``log_lock``.
+    """
+    with atomic_write(path) as f:
+        for message in messages:
+            f.write(encode_message(message))
+
+
+def migrate_legacy_messages(legacy_path=LEGACY_MESSAGES_FILE, path=MESSAGES_LOG):
+    """Convert an old messages.json array into the log (runs once)
+
+    The legacy file is kept next to the log as ``<name>.migrated`` so the
+    conversion never loses data. Returns True if a migration happened.
+    """
+    if os.path.exists(path) or not os.path.exists(legacy_path):
+        return False
+
+    with log_lock(path):
+        # Another process may have migrated while we waited
+        if os.path.exists(path) or not os.path.exists(legacy_path):
+            return False
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                messages = json.load(f)
+        except (OSError, ValueError):
+            # Leave an unreadable legacy file alone rather than hide it
+            return False
+
+        number_messages(messages)
+        write_messages(messages, path)
+        os.replace(legacy_path, legacy_path + ".migrated")
+        return True
+
+
+def ensure_message_ids(path=MESSAGES_LOG):
+    """Number a log written before messages had IDs (runs once)
+
+    Returns True if the log was rewritten.
+    """
+    with log_lock(path):
+        last = read_last_messages(1, path)
+        if not last or "id" in last[0]:
+            return False
+        messages = read_messages(path)
+        number_messages(messages)
+        write_messages(messages, path)
+        return True
@@ -0,0 +1,207 @@
+"""Compact in-memory messages.
+
+Stored messages are JSON objects like ``{"id": 7, "username": "ahad",
+"message": "hi", "timestamp": "2024-05-01 12:00:00"}``. Held as dicts,
+every loaded copy carries its own hash table, its own copy of the
+sender's name and a 19-character timestamp string that time-range work
+has to compare or re-parse.
+
+A ``Message`` holds the same data in four slots: the ID, the sender's
+name interned (one shared string per user however many messages they
+sent), the text, and the time as integer microseconds since the epoch.
+The wall-clock time is counted as if it were UTC, so no time-zone rules
+are involved and converting back gives exactly the text that was read.
+A message in any other shape (extra keys, a missing ID, a timestamp in
+another format) also keeps the original dict, so conversion is always
+lossless.
+
+Messages are read-only mappings with the JSON keys (``m["timestamp"]``,
+``m.get("id")``, ``dict(m)``, ``{**m}``), so code written for dicts keeps
+working; the hot paths read the attributes. ``plain`` lets ``json.dumps``
+write them.
+"""
+import functools
+import sys
+from collections.abc import Mapping
+from datetime import date, datetime
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+FIELDS = ("id", "username", "message", "timestamp")
+EPOCH = datetime(1970, 1, 1)
+EPOCH_DAY = EPOCH.toordinal()
+SECOND = 1000000  # Microseconds
+DAY = 86400 * SECOND
+# "HH:MM" for every minute of the day and ":SS" for every second, so formatting is a lookup
+_CLOCK = tuple(f"{hour:02d}:{minute:02d}" for hour in range(24) for minute in range(60))
+_SECONDS = tuple(f":{second:02d}" for second in range(60))
+
+
+def parse_timestamp(text):
+    """Microseconds since the epoch of a stored timestamp, or None if it is not in the stored format
+
+    The stored format is ``"%Y-%m-%d %H:%M:%S"``, optionally with six
+    digits of fraction; anything else would not convert back unchanged.
+    """
+    if type(text) is not str or len(text) not in (19, 26):
+        return None
+    if text[4] != "-" or text[7] != "-" or text[10] != " " or text[13] != ":" or text[16] != ":":
+        return None
+    if len(text) == 26 and text[19] != ".":
+        return None
+    try:
+        moment = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if moment.tzinfo is not None or (len(text) == 26 and not moment.microsecond):
+        return None
+    return _microseconds(moment)
+
+
+def _microseconds(moment):
+    # Plain arithmetic: subtracting datetimes costs more than parsing one
+    seconds = (moment.toordinal() - EPOCH_DAY) * 86400 + moment.hour * 3600 + moment.minute * 60 + moment.second
+    return seconds * SECOND + moment.microsecond
+
+
+def format_timestamp(time):
+    """The stored timestamp for ``time`` microseconds since the epoch"""
+    days, rest = divmod(time, DAY)
+    seconds, microsecond = divmod(rest, SECOND)
+    minutes, second = divmod(seconds, 60)
+    text = f"{_day(days)} {_CLOCK[minutes]}{_SECONDS[second]}"
+    return f"{text}.{microsecond:06d}" if microsecond else text
+
+
+def time_bound(text, end=False):
+    """``text`` (a timestamp or the start of one, e.g. ``"2024-05-01"``) as microseconds, or None if unreadable
+
+    Matches comparing the strings: an ``end`` bound that is only the
+    start of a timestamp excludes the times it is the start of.
+    """
+    try:
+        moment = datetime.fromisoformat(text)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is not None:
+        return None
+    time = _microseconds(moment)
+    return time - 1 if end and len(text) < 19 else time
+
+
+@functools.lru_cache(maxsize=4096)
+def _day(number):
+    return date.fromordinal(EPOCH_DAY + number).isoformat()
+
+
+class Message(Mapping):
+    """One chat message; see the module docstring"""
+
+    __slots__ = ("id", "user", "text", "time", "extra")
+
+    def __init__(self, id, user, text, time, extra=None):
+        self.id = id
+        self.user = user
+        self.text = text
+        self.time = time  # Microseconds since the epoch, None if the timestamp is missing or odd
+        self.extra = extra  # The original dict, for messages not in the usual shape
+
+    def __getitem__(self, key):
+        if self.extra is not None:
+            return self.extra[key]
+        if key == "id":
+            return self.id
+        if key == "username":
+            return self.user
+        if key == "message":
+            return self.text
+        if key == "timestamp":
+            return format_timestamp(self.time)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.extra if self.extra is not None else key in FIELDS
+
+    def __iter__(self):
+        return iter(self.extra if self.extra is not None else FIELDS)
+
+    def __len__(self):
+        return len(self.extra) if self.extra is not None else len(FIELDS)
+
+    def __setitem__(self, key, value):
+        # Only used to number messages stored before IDs existed
+        data = self.as_dict()
+        data[key] = value
+        other = to_message(data)
+        for name in self.__slots__:
+            setattr(self, name, getattr(other, name))
+
+    def __eq__(self, other):
+        if type(other) is Message and self.extra is None and other.extra is None:
+            return (self.id, self.time, self.user, self.text) == (other.id, other.time, other.user, other.text)
+        return Mapping.__eq__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Message({self.as_dict()!r})"
+
+    @property
+    def timestamp(self):
+        """The stored timestamp text ("" if missing)"""
+        if self.time is not None:
+            return format_timestamp(self.time)
+        return self.get("timestamp") or ""
+
+    @property
+    def day(self):
+        """``"YYYY-MM-DD"`` of the timestamp ("" if missing)"""
+        if self.time is not None:
+            return _day(self.time // DAY)
+        return self.timestamp[:10]
+
+    def as_dict(self):
+        """The message as the dict it was read from"""
+        if self.extra is not None:
+            return dict(self.extra)
+        return {"id": self.id, "username": self.user, "message": self.text, "timestamp": format_timestamp(self.time)}
+
+
+def new_message(id, username, text, timestamp):
+    """Message from its four stored fields"""
+    time = parse_timestamp(timestamp)
+    if time is None or type(id) is not int or type(username) is not str or type(text) is not str:
+        return to_message({"id": id, "username": username, "message": text, "timestamp": timestamp})
+    return Message(id, sys.intern(username), text, time)
+
+
+def to_message(data):
+    """``data`` (a message dict as stored, or a Message) as a Message"""
+    if type(data) is Message:
+        return data
+    if len(data) == 4:
+        try:
+            id, username, text, timestamp = data["id"], data["username"], data["message"], data["timestamp"]
+        except KeyError:
+            pass
+        else:
+            time = parse_timestamp(timestamp)
+            if time is not None and type(id) is int and type(username) is str and type(text) is str:
+                return Message(id, sys.intern(username), text, time)
+    username = data.get("username")
+    return Message(
+        data.get("id"), sys.intern(username) if type(username) is str else username, data.get("message"),
+        parse_timestamp(data.get("timestamp")), dict(data)
+    )
+
+
+def plain(value):
+    """``default`` for ``json.dumps``: messages are written as the dicts they came from"""
+    if type(value) is Message:
+        return value.as_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
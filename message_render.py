@@ -0,0 +1,69 @@
+"""HTML rendering of the message list.
+
+The visible messages are rendered into one HTML block with a shared
+stylesheet, so a refresh sends a single element to the browser instead
+of several per message. Each message's fragment comes from a fixed
+template with every piece of text escaped, and is cached: the same
+message looks the same in every session, so it is only formatted once
+per process.
+"""
+import functools
+import html
+
+from message_model import format_timestamp, to_message
+from metrics import shared_metrics
+
+FRAGMENT_CACHE_SIZE = 4096  # Rendered messages kept per process
+
+STYLESHEET = """
+<style>
+.ac-chat { display: flex; flex-direction: column; gap: 10px; }
+.ac-msg { display: flex; flex-direction: column; max-width: 70%; }
+.ac-mine { align-self: flex-end; align-items: flex-end; }
+.ac-theirs { align-self: flex-start; align-items: flex-start; }
+.ac-bubble { padding: 10px; border-radius: 15px; text-align: left; overflow-wrap: anywhere; }
+.ac-mine .ac-bubble { background-color: #007ACC; color: white; }
+.ac-theirs .ac-bubble { background-color: #E8E8E8; color: black; }
+.ac-time { font-size: 12px; color: #666; margin-top: 5px; }
+</style>
+"""
+
+MESSAGE_TEMPLATE = (
+    '<div class="ac-msg ac-{side}">'
+    '<div class="ac-bubble"><strong>{name}</strong><br>{text}</div>'
+    '<div class="ac-time">{timestamp}{note}</div>'
+    '</div>'
+)
+
+
+@functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def render_fragment(mine, name, text, time, note=""):
+    """HTML for one message (cached by what it shows; ``time`` is a Message's time or timestamp text)"""
+    timestamp = format_timestamp(time) if type(time) is int else time
+    return MESSAGE_TEMPLATE.format(
+        side="mine" if mine else "theirs",
+        name=html.escape(name),
+        text=html.escape(text),
+        timestamp=html.escape(timestamp),
+        note=html.escape(note),
+    )
+
+
+def render_messages(messages, viewer, display_name, pending=()):
+    """One HTML block for ``messages`` as seen by ``viewer``
+
+    ``display_name`` maps a username to the name shown on the other
+    person's messages. Messages in ``pending`` are marked as still sending.
+    """
+    with shared_metrics.timer("render"):
+        fragments = []
+        for message in messages:
+            note = " ⏳ sending..." if pending and message in pending else ""
+            message = to_message(message)
+            mine = message.user == viewer
+            fragments.append(render_fragment(
+                mine, "You" if mine else display_name(message.user), message.text,
+                message.time if message.time is not None else message.timestamp, note
+            ))
+        # No blank lines, so Markdown leaves the whole block alone
+        return STYLESHEET.strip().replace("\n", " ") + '<div class="ac-chat">' + "".join(fragments) + "</div>"
@@ -0,0 +1,101 @@
+"""Running statistics over the stored messages.
+
+Every store keeps one small aggregate next to its messages and folds each
+write into it, so the admin panel reads a handful of numbers instead of
+scanning and re-serialising the whole history. A rewrite (cleanup)
+recomputes the aggregate from the messages it keeps; retention subtracts
+the statistics of the messages it moves out.
+"""
+import json
+
+from message_log import atomic_write, encode_message, message_id
+from message_model import format_timestamp, to_message
+
+
+def new_stats():
+    """Statistics of an empty history"""
+    return {
+        "total": 0,
+        "bytes": 0,  # Size of the messages as stored, one JSON line each
+        "users": {},  # Messages per username
+        "days": {},  # Messages per "YYYY-MM-DD"
+        "first": None,
+        "last": None,
+        "last_id": 0,  # Newest message folded in, to spot a stale aggregate
+    }
+
+
+def message_size(message):
+    """Bytes one message takes up in storage"""
+    return len(encode_message(message).encode("utf-8"))
+
+
+def add_messages(stats, messages):
+    """Fold ``messages`` into ``stats`` and return it"""
+    users = stats["users"]
+    days = stats["days"]
+    earliest = latest = None  # Integer times, turned into timestamps once at the end
+    timestamps = [t for t in (stats["first"], stats["last"]) if t]
+    for message in messages:
+        message = to_message(message)
+        stats["total"] += 1
+        stats["bytes"] += message_size(message)
+        users[message.user] = users.get(message.user, 0) + 1
+        stats["last_id"] = max(stats["last_id"], message_id(message))
+        time = message.time
+        if time is not None:
+            if earliest is None or time < earliest:
+                earliest = time
+            if latest is None or time > latest:
+                latest = time
+        elif message.timestamp:
+            # Not in the stored format: compared as text
+            timestamps = [min(timestamps + [message.timestamp]), max(timestamps + [message.timestamp])]
+        day = message.day
+        if day:
+            days[day] = days.get(day, 0) + 1
+    timestamps.extend(format_timestamp(t) for t in (earliest, latest) if t is not None)
+    if timestamps:
+        stats["first"] = min(timestamps)
+        stats["last"] = max(timestamps)
+    return stats
+
+
+def remove_stats(stats, removed, first=None):
+    """Take ``removed``, the statistics of the oldest messages, out of ``stats`` and return it
+
+    ``first`` is the timestamp of the oldest message left. ``last_id``
+    stays, since IDs are never reused.
+    """
+    stats["total"] -= removed["total"]
+    stats["bytes"] -= removed["bytes"]
+    for field in ("users", "days"):
+        counts = stats[field]
+        for key, count in removed[field].items():
+            counts[key] = counts.get(key, 0) - count
+            if counts[key] <= 0:
+                del counts[key]
+    stats["first"] = first
+    if stats["total"] <= 0:
+        stats["last"] = None
+    return stats
+
+
+def compute_stats(messages):
+    """Statistics of ``messages``, from scratch"""
+    return add_messages(new_stats(), messages)
+
+
+def read_stats_file(path):
+    """Statistics saved at ``path``, or None if missing or unreadable"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_stats_file(stats, path):
+    """Save statistics to ``path``, replacing the file atomically"""
+    with atomic_write(path, sync=False) as f:
+        json.dump(stats, f, ensure_ascii=False)
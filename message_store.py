@@ -0,0 +1,751 @@
+"""Pluggable message storage shared by both versions of AhadChat.
+
+Both apps talk to a ``MessageStore``. A backend only implements a few
+primitives (``_append``, ``_recent``, ``_since``, ``_before``, ``_all``,
+``_replace_all`` and ``_drop_before``); the base class adds what every backend shares: the
+timestamp on new messages, the process-wide cache of recent messages,
+the full-text search index, notifying the other sessions after each
+write and timing every call (see metrics). Messages come back as compact
+``message_model.Message`` records, which read like the stored dicts.
+
+Backends here:
+
+* ``JsonFileStore`` - the append-only ``messages.jsonl`` log
+* ``SqliteStore`` - an SQLite database in WAL mode, for large histories and
+  many simultaneous writers
+* ``MemoryStore`` - a plain list, used for the cloud version's demo mode
+
+The Gist backend is ``gist_segments.SegmentedGist``.
+"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+
+from message_cache import shared_cache
+from message_log import (
+    LEGACY_MESSAGES_FILE, MESSAGES_LOG, append_new_messages, atomic_write, ensure_message_ids, log_lock, log_version,
+    iter_messages, message_id, migrate_legacy_messages, number_messages, read_last_messages, read_messages,
+    decode_line, iter_lines, iter_lines_reversed, read_messages_before, read_messages_since, read_page_before,
+    write_messages
+)
+from message_model import TIMESTAMP_FORMAT, new_message, time_bound, to_message
+from message_stats import add_messages, compute_stats, new_stats, read_stats_file, remove_stats, write_stats_file
+from metrics import shared_metrics
+from notifier import shared_notifier
+from search_index import INDEX_SAVE_INTERVAL, SEARCH_LIMIT, SearchIndex, load_index, parse_query
+
+SQLITE_FILE = "messages.db"
+EXPIRE_BATCH_SIZE = 5000  # Messages removed per step when expiring old history
+
+
+class KeepLog(Exception):
+    """Raised inside ``atomic_write`` to drop a copy of the log instead of replacing it"""
+
+
+def in_range(messages, start=None, end=None):
+    """Messages whose timestamp lies between ``start`` and ``end`` (inclusive, either may be None)"""
+    if start is None and end is None:
+        yield from messages
+        return
+    # Compare the integer times of compact messages rather than the timestamp strings
+    low = time_bound(start) if start is not None else None
+    high = time_bound(end, end=True) if end is not None else None
+    exact = (start is None or low is not None) and (end is None or high is not None)
+    for message in messages:
+        time = getattr(message, "time", None)
+        if exact and time is not None:
+            if (low is None or time >= low) and (high is None or time <= high):
+                yield message
+            continue
+        timestamp = message.get("timestamp") or ""
+        if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+            yield message
+
+
+class MessageStore:
+    """Base class for message storage backends
+
+    ``key`` names the store in the shared cache and the notifier. Stores
+    whose ``version()`` cannot tell when remote data changed set
+    ``cache_max_age`` so cached copies expire by age instead. Stores with
+    a ``search_index_path`` save their search index there between runs.
+    """
+
+    use_cache = True
+    search_index_path = None
+
+    def __init__(self, key, cache_max_age=None):
+        self.key = key
+        self.rewritten_key = key + ":rewritten"
+        self.cache_max_age = cache_max_age
+        self._index = None  # Loaded on the first search
+        self._index_lock = threading.Lock()
+
+    # Backend primitives
+
+    def version(self):
+        """Cheap value that changes whenever the stored messages change (None if unknown)"""
+        return None
+
+    def _append(self, messages):
+        raise NotImplementedError
+
+    def _recent(self, limit):
+        """``(last limit messages, total)``"""
+        raise NotImplementedError
+
+    def _count(self):
+        """Number of stored messages, or None if the backend cannot tell cheaply"""
+        return None
+
+    def _since(self, since_id):
+        raise NotImplementedError
+
+    def _before(self, before_id, limit):
+        raise NotImplementedError
+
+    def _all(self):
+        raise NotImplementedError
+
+    def _replace_all(self, messages):
+        raise NotImplementedError
+
+    def _drop_before(self, before_id):
+        """Remove the messages with an ID lower than ``before_id``, returning how many went"""
+        raise NotImplementedError
+
+    def _stats(self):
+        """Running statistics (see message_stats); backends keep them up to date on every write"""
+        return compute_stats(self._all())
+
+    def _older(self, cursor, limit):
+        messages = self._before(cursor, limit)
+        return messages, (message_id(messages[0]) if len(messages) == limit else None)
+
+    def _stream(self, start, end):
+        """Messages with ``start <= timestamp <= end``, one at a time; backends may skip what is out of range"""
+        return in_range(self._all(), start, end)
+
+    def _get(self, ids, index):
+        """The messages with the given IDs, in any order; backends that can look messages up override this"""
+        wanted = set(ids)
+        return [m for m in self._stream(None, None) if message_id(m) in wanted]
+
+    def _index_new(self, index):
+        """Add the messages stored after ``index.last_id`` to the search index"""
+        index.add(self._since(index.last_id) if index.last_id else self._stream(None, None))
+
+    def _index_appended(self, index, stored):
+        index.append(stored)
+
+    # Shared behaviour
+
+    def _cached(self):
+        messages, total = shared_cache.get(
+            self.key, self.version(),
+            lambda: self._recent(shared_cache.max_messages),
+            max_age=self.cache_max_age
+        )
+        # Wake the other sessions only if this load found something new
+        shared_notifier.publish(self.key, signature=(total, message_id(messages[-1]) if messages else 0))
+        return messages, total
+
+    def _changed(self, rewritten=False):
+        shared_cache.invalidate(self.key)
+        if rewritten:
+            shared_notifier.publish(self.rewritten_key)
+        shared_notifier.publish(self.key)
+
+    def add(self, username, text):
+        """Store a new message from ``username`` and return the stored copy"""
+        message = {
+            "username": username,
+            "message": text,
+            "timestamp": datetime.now().strftime(TIMESTAMP_FORMAT)
+        }
+        return self.append([message])[0]
+
+    def append(self, messages):
+        """Store messages under new sequence IDs and return the stored copies"""
+        with shared_metrics.timer("storage.append"):
+            stored = self._append(list(messages))
+        if self._index is not None:
+            # Anything this skips (messages stored elsewhere in between) is caught up by the next search
+            with self._index_lock:
+                self._index_appended(self._index, stored)
+        self._changed()
+        return stored
+
+    def recent(self, limit):
+        """The last ``limit`` messages and the total number stored (None if unknown)"""
+        if limit <= 0:
+            return [], None
+        with shared_metrics.timer("storage.recent"):
+            if not self.use_cache or limit > shared_cache.max_messages:
+                return self._recent(limit)
+            messages, total = self._cached()
+            return messages[-limit:], total
+
+    def since(self, since_id):
+        """Messages with an ID greater than ``since_id`` and the total number stored"""
+        with shared_metrics.timer("storage.since"):
+            if not self.use_cache:
+                return self._since(since_id), self._count()
+            messages, total = self._cached()
+            complete = len(messages) < shared_cache.max_messages or len(messages) == total
+            if messages and not complete and message_id(messages[0]) > since_id + 1:
+                # More is new than the cache holds
+                return self._since(since_id), total
+            return [m for m in messages if message_id(m) > since_id], total
+
+    def before(self, before_id, limit):
+        """Up to ``limit`` messages older than the message with ID ``before_id``, oldest first"""
+        with shared_metrics.timer("storage.before"):
+            return self._before(before_id, limit)
+
+    def older(self, cursor, limit):
+        """A page of up to ``limit`` messages older than ``cursor``, oldest first, and the cursor for the page before it
+
+        Start from the ID of the oldest message on screen and pass each
+        returned cursor back to keep paging; it is None once nothing older
+        is left. Each step costs about one page, not the whole history.
+        """
+        with shared_metrics.timer("storage.older"):
+            return self._older(cursor, limit)
+
+    def all(self):
+        """Every stored message, oldest first"""
+        with shared_metrics.timer("storage.all"):
+            return self._all()
+
+    def stream(self, start=None, end=None):
+        """Every message, oldest first, yielded one at a time rather than loaded together
+
+        ``start`` and ``end`` bound the timestamps (inclusive, compared as
+        stored, e.g. ``"2024-05-01"`` to ``"2024-05-31 23:59:59"``).
+        """
+        return self._stream(start, end)
+
+    def stats(self):
+        """Message count, size, per-user and per-day counts and first/last timestamps"""
+        with shared_metrics.timer("stats"):
+            return self._stats()
+
+    def search(self, query, users=None, start=None, end=None, limit=SEARCH_LIMIT):
+        """Up to ``limit`` messages holding every word of ``query``, newest first
+
+        ``word*`` matches any word starting with ``word``. ``users`` limits
+        the senders and ``start``/``end`` the timestamps, as in ``stream``.
+        """
+        with shared_metrics.timer("storage.search"):
+            index = self._search_index()
+            ids = index.search(query, users, start, end, limit)
+            found = {message_id(m): m for m in in_range(self._get(ids, index), start, end)}
+            return [found[i] for i in ids if i in found]
+
+    def _search_index(self):
+        """The search index, loaded or built on first use and brought up to date"""
+        with self._index_lock:
+            index = self._index
+            if index is None and self.search_index_path:
+                index = load_index(self.search_index_path)
+            if index is None:
+                index = SearchIndex()
+            self._index_new(index)
+            if index.count > self.stats()["total"]:
+                # Indexes messages that are gone: rewritten elsewhere (a cleanup in another process)
+                index = SearchIndex()
+                self._index_new(index)
+            self._index = index
+            if self.search_index_path and index.unsaved >= INDEX_SAVE_INTERVAL:
+                index.save(self.search_index_path)
+        return index
+
+    def _drop_index(self):
+        with self._index_lock:
+            self._index = None
+            if self.search_index_path and os.path.exists(self.search_index_path):
+                os.remove(self.search_index_path)
+
+    def expire(self, before_id):
+        """Remove the messages older than ``before_id`` and return how many went
+
+        Used by retention once those messages are archived. Backends remove
+        them without holding up sends for long.
+        """
+        try:
+            with shared_metrics.timer("storage.expire"):
+                return self._drop_before(before_id)
+        finally:
+            self._drop_index()
+            self._changed(rewritten=True)
+
+    def replace_all(self, messages):
+        """Replace the whole history (messages keep their IDs, new ones are numbered)
+
+        The search index is rebuilt from what is left on the next search.
+        """
+        try:
+            with shared_metrics.timer("storage.replace_all"):
+                self._replace_all(list(messages))
+        finally:
+            # A failed rewrite may still have changed part of the history
+            self._drop_index()
+            self._changed(rewritten=True)
+
+
+class JsonFileStore(MessageStore):
+    """Messages in the append-only JSON Lines log (see message_log)"""
+
+    def __init__(self, path=MESSAGES_LOG, legacy_path=LEGACY_MESSAGES_FILE):
+        super().__init__(path)
+        self.path = path
+        self.stats_path = os.path.splitext(path)[0] + ".stats.json"
+        self.search_index_path = os.path.splitext(path)[0] + ".index"
+        # Bring older layouts up to date (first run only)
+        if legacy_path:
+            migrate_legacy_messages(legacy_path, path)
+        ensure_message_ids(path)
+
+    def version(self):
+        return log_version(self.path)
+
+    def _append(self, messages):
+        with log_lock(self.path):
+            stats = self._stats()
+            stored = append_new_messages(messages, self.path)
+            write_stats_file(add_messages(stats, stored), self.stats_path)
+        return stored
+
+    def _recent(self, limit):
+        return read_last_messages(limit, self.path), None
+
+    def _since(self, since_id):
+        return read_messages_since(since_id, self.path)
+
+    def _before(self, before_id, limit):
+        return read_messages_before(before_id, limit, self.path)
+
+    def _older(self, cursor, limit):
+        # The cursor carries where the last page started in the log
+        before_id, offset = cursor if isinstance(cursor, tuple) else (cursor, None)
+        messages, offset = read_page_before(before_id, limit, self.path, offset)
+        return messages, ((message_id(messages[0]), offset) if len(messages) == limit else None)
+
+    def _all(self):
+        return read_messages(self.path)
+
+    def _stream(self, start, end):
+        return in_range(iter_messages(self.path), start, end)
+
+    def _get(self, ids, index):
+        # The index knows where each message starts in the log
+        found = []
+        if not ids or not os.path.exists(self.path):
+            return found
+        with open(self.path, "rb") as f:
+            for doc in ids:
+                offset = index.location(doc)
+                if offset is None:
+                    continue
+                f.seek(offset)
+                message = decode_line(f.readline())
+                if message is not None and message_id(message) == doc:
+                    found.append(message)
+        return found
+
+    def _index_new(self, index):
+        # Find where the unindexed messages start, then read them forwards with their offsets
+        start = None
+        if index.last_id == 0:
+            start = 0
+        else:
+            for offset, line in iter_lines_reversed(self.path):
+                message = decode_line(line)
+                if message is not None and message_id(message) <= index.last_id:
+                    break
+                start = offset
+        if start is None:
+            return
+        messages, offsets = [], []
+        for offset, line in iter_lines(self.path, start):
+            message = decode_line(line)
+            if message is not None:
+                messages.append(message)
+                offsets.append(offset)
+            if len(messages) >= INDEX_SAVE_INTERVAL:
+                index.add(messages, offsets)
+                messages, offsets = [], []
+        index.add(messages, offsets)
+
+    def _index_appended(self, index, stored):
+        self._index_new(index)
+
+    def _replace_all(self, messages):
+        with log_lock(self.path):
+            last = read_last_messages(1, self.path)
+            number_messages(messages, message_id(last[0]) + 1 if last else 1)
+            write_messages(messages, self.path)
+            write_stats_file(compute_stats(messages), self.stats_path)
+
+    def _drop_before(self, before_id):
+        # The kept messages are copied to a new log while sends carry on;
+        # only what was appended meanwhile is copied under the lock
+        if not os.path.exists(self.path):
+            return 0
+        removed = new_stats()
+        first = None
+
+        def copy(src, dst, complete_only):
+            nonlocal first
+            while True:
+                line = src.readline()
+                if not line or (complete_only and not line.endswith(b"\n")):
+                    # End of the log, or a line that is still being written
+                    src.seek(-len(line), os.SEEK_CUR)
+                    return
+                if first is None:
+                    message = decode_line(line)
+                    if message is None:
+                        continue
+                    if message_id(message) < before_id:
+                        add_messages(removed, [message])
+                        continue
+                    first = message.get("timestamp")
+                dst.write(line)
+
+        with open(self.path, "rb") as src, ExitStack() as locked:
+            try:
+                with atomic_write(self.path, "wb") as dst:
+                    copy(src, dst, complete_only=True)
+                    # Held until the copy has replaced the log
+                    locked.enter_context(log_lock(self.path))
+                    if os.stat(self.path).st_ino != os.fstat(src.fileno()).st_ino:
+                        # Rewritten meanwhile; retention tries again later
+                        raise KeepLog
+                    copy(src, dst, complete_only=False)
+                    # Windows cannot replace a file that is still open
+                    src.close()
+                    if not removed["total"]:
+                        raise KeepLog
+                    stats = self._stats()
+            except KeepLog:
+                return 0
+            write_stats_file(remove_stats(stats, removed, first), self.stats_path)
+            return removed["total"]
+
+    def _stats(self):
+        stats = read_stats_file(self.stats_path)
+        last = read_last_messages(1, self.path)
+        if stats is not None and stats["last_id"] == (message_id(last[0]) if last else 0):
+            return stats
+        # Missing, or the log was changed behind our back: count once more
+        with log_lock(self.path):
+            stats = compute_stats(read_messages(self.path))
+            write_stats_file(stats, self.stats_path)
+        return stats
+
+
+class MemoryStore(MessageStore):
+    """Messages in a list that lives as long as the store object"""
+
+    use_cache = False
+
+    def __init__(self, key="memory"):
+        super().__init__(key)
+        self.messages = []
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._stats_aggregate = new_stats()
+
+    def _append(self, messages):
+        with self._lock:
+            stored = [to_message({"id": self._next_id + i, **message}) for i, message in enumerate(messages)]
+            self._next_id += len(stored)
+            self.messages.extend(stored)
+            add_messages(self._stats_aggregate, stored)
+        return stored
+
+    def _recent(self, limit):
+        return (self.messages[-limit:] if limit > 0 else []), len(self.messages)
+
+    def _count(self):
+        return len(self.messages)
+
+    def _since(self, since_id):
+        return [m for m in self.messages if message_id(m) > since_id]
+
+    @staticmethod
+    def _position(messages, doc):
+        # IDs increase along the list, so binary search for the first ID >= doc
+        low, high = 0, len(messages)
+        while low < high:
+            middle = (low + high) // 2
+            if message_id(messages[middle]) < doc:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _before(self, before_id, limit):
+        messages = self.messages
+        low = self._position(messages, before_id)
+        return messages[max(low - limit, 0):low] if limit > 0 else []
+
+    def _get(self, ids, index):
+        messages = self.messages
+        positions = (self._position(messages, doc) for doc in ids)
+        return [messages[p] for p, doc in zip(positions, ids) if p < len(messages) and message_id(messages[p]) == doc]
+
+    def _all(self):
+        return list(self.messages)
+
+    def _replace_all(self, messages):
+        messages = [to_message(m) for m in messages]
+        with self._lock:
+            self._next_id = number_messages(messages, self._next_id)
+            self.messages = messages
+            self._stats_aggregate = compute_stats(messages)
+
+    def _drop_before(self, before_id):
+        with self._lock:
+            cut = self._position(self.messages, before_id)
+            removed, self.messages = self.messages[:cut], self.messages[cut:]
+            remove_stats(self._stats_aggregate, compute_stats(removed), self.messages[0].get("timestamp") if self.messages else None)
+        return len(removed)
+
+    def _stats(self):
+        # A copy, so callers cannot change the aggregate later writes fold into
+        with self._lock:
+            stats = self._stats_aggregate
+            return {**stats, "users": dict(stats["users"]), "days": dict(stats["days"])}
+
+
+class SqliteStore(MessageStore):
+    """Messages in an SQLite database
+
+    The database runs in WAL mode so readers never block the writer, and
+    every thread gets its own connection. IDs come from an AUTOINCREMENT
+    key, so they keep increasing even after the history is cleared. A
+    ``meta`` row counts writes, which makes ``version()`` a single
+    primary-key lookup, and the ``stats`` row holds the running statistics,
+    updated in the same transaction as the messages. Search uses an FTS5
+    table over the message text, also written in the same transaction; an
+    SQLite built without FTS5 falls back to the generic search index.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_by_user ON messages (username, id);
+        CREATE INDEX IF NOT EXISTS messages_by_time ON messages (timestamp);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0), ('count', 0);
+        CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value TEXT NOT NULL
+        );
+    """
+
+    TEXT_INDEX = "CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts5 (message, content='messages', content_rowid='id', prefix='2 3')"
+
+    def __init__(self, path=SQLITE_FILE, timeout=10.0):
+        super().__init__(path)
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(self.SCHEMA)
+        self.full_text = True
+        try:
+            new_index = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_text'").fetchone() is None
+            conn.execute(self.TEXT_INDEX)
+        except sqlite3.OperationalError:
+            self.full_text = False
+            self.search_index_path = os.path.splitext(path)[0] + ".index"
+        else:
+            if new_index:
+                # Database from before search: index what is there
+                with self._transaction() as conn:
+                    conn.execute("INSERT INTO messages_text (messages_text) VALUES ('rebuild')")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        # Take the write lock up front so concurrent writers wait their turn instead of failing
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _to_message(row):
+        return new_message(row["id"], row["username"], row["message"], row["timestamp"])
+
+    def _bump(self, conn, count_delta=0, count=None):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'revision'")
+        if count is not None:
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'count'", (count,))
+        else:
+            conn.execute("UPDATE meta SET value = value + ? WHERE key = 'count'", (count_delta,))
+
+    def _count(self):
+        return self._connection().execute("SELECT value FROM meta WHERE key = 'count'").fetchone()[0]
+
+    def _read_stats(self, conn):
+        row = conn.execute("SELECT value FROM stats WHERE id = 1").fetchone()
+        if row is not None:
+            return json.loads(row[0])
+        # Database from before statistics were kept
+        return compute_stats(self._to_message(r) for r in conn.execute("SELECT * FROM messages ORDER BY id"))
+
+    def _write_stats(self, conn, stats):
+        conn.execute("INSERT OR REPLACE INTO stats (id, value) VALUES (1, ?)", (json.dumps(stats, ensure_ascii=False),))
+
+    def _stats(self):
+        return self._read_stats(self._connection())
+
+    def version(self):
+        return self._connection().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+
+    def _append(self, messages):
+        stored = []
+        with self._transaction() as conn:
+            stats = self._read_stats(conn)
+            for message in messages:
+                cursor = conn.execute(
+                    "INSERT INTO messages (username, message, timestamp) VALUES (?, ?, ?)",
+                    (message["username"], message["message"], message["timestamp"])
+                )
+                stored.append(to_message({"id": cursor.lastrowid, **message}))
+            if self.full_text:
+                conn.executemany(
+                    "INSERT INTO messages_text (rowid, message) VALUES (?, ?)",
+                    [(m["id"], m["message"]) for m in stored]
+                )
+            self._bump(conn, count_delta=len(stored))
+            self._write_stats(conn, add_messages(stats, stored))
+        return stored
+
+    def _recent(self, limit):
+        conn = self._connection()
+        rows = conn.execute("SELECT * FROM messages ORDER BY id DESC LIMIT ?", (max(limit, 0),)).fetchall()
+        return [self._to_message(row) for row in reversed(rows)], self._count()
+
+    def _since(self, since_id):
+        rows = self._connection().execute("SELECT * FROM messages WHERE id > ? ORDER BY id", (since_id,))
+        return [self._to_message(row) for row in rows]
+
+    def _before(self, before_id, limit):
+        # Keyset pagination: walks the primary key index, no OFFSET scan
+        rows = self._connection().execute(
+            "SELECT * FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?", (before_id, limit)
+        ).fetchall()
+        return [self._to_message(row) for row in reversed(rows)]
+
+    def _all(self):
+        rows = self._connection().execute("SELECT * FROM messages ORDER BY id")
+        return [self._to_message(row) for row in rows]
+
+    def _stream(self, start, end):
+        # Rows are fetched from the cursor as they are consumed
+        rows = self._connection().execute(
+            "SELECT * FROM messages WHERE timestamp >= ? AND timestamp <= ? ORDER BY id",
+            (start if start is not None else "", end if end is not None else "\uffff")
+        )
+        try:
+            for row in rows:
+                yield self._to_message(row)
+        finally:
+            # A half-read cursor would pin this connection's read snapshot
+            rows.close()
+
+    def _get(self, ids, index):
+        ids = list(ids)
+        rows = self._connection().execute(f"SELECT * FROM messages WHERE id IN ({', '.join('?' * len(ids))})", ids)
+        return [self._to_message(row) for row in rows]
+
+    def search(self, query, users=None, start=None, end=None, limit=SEARCH_LIMIT):
+        if not self.full_text:
+            return super().search(query, users, start, end, limit)
+        terms = parse_query(query)
+        if not terms or limit <= 0 or (users is not None and not users):
+            return []
+        # Words are letters, digits and underscores, so quoting them is enough
+        sql = "SELECT messages.* FROM messages_text JOIN messages ON messages.id = messages_text.rowid WHERE messages_text MATCH ?"
+        params = [" ".join(f'"{word}"' + ("*" if prefix else "") for word, prefix in terms)]
+        if users is not None:
+            sql += f" AND messages.username IN ({', '.join('?' * len(users))})"
+            params.extend(users)
+        if start is not None:
+            sql += " AND messages.timestamp >= ?"
+            params.append(start)
+        if end is not None:
+            sql += " AND messages.timestamp <= ?"
+            params.append(end)
+        sql += " ORDER BY messages_text.rowid DESC LIMIT ?"
+        params.append(limit)
+        with shared_metrics.timer("storage.search"):
+            return [self._to_message(row) for row in self._connection().execute(sql, params)]
+
+    def _replace_all(self, messages):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM messages")
+            stored = []
+            for message in messages:
+                cursor = conn.execute(
+                    "INSERT INTO messages (id, username, message, timestamp) VALUES (?, ?, ?, ?)",
+                    (message.get("id"), message["username"], message["message"], message["timestamp"])
+                )
+                # Messages without an ID get one here; the statistics need it
+                stored.append({**message, "id": cursor.lastrowid})
+            if self.full_text:
+                conn.execute("INSERT INTO messages_text (messages_text) VALUES ('rebuild')")
+            self._bump(conn, count=len(stored))
+            self._write_stats(conn, compute_stats(stored))
+
+    def _drop_before(self, before_id):
+        # Short transactions, so sends get in between the steps
+        removed = 0
+        while True:
+            with self._transaction() as conn:
+                stats = self._read_stats(conn)
+                rows = conn.execute(
+                    "SELECT * FROM messages WHERE id < ? ORDER BY id LIMIT ?", (before_id, EXPIRE_BATCH_SIZE)
+                ).fetchall()
+                if not rows:
+                    return removed
+                batch = [self._to_message(row) for row in rows]
+                if self.full_text:
+                    conn.executemany(
+                        "INSERT INTO messages_text (messages_text, rowid, message) VALUES ('delete', ?, ?)",
+                        [(m["id"], m["message"]) for m in batch]
+                    )
+                conn.execute("DELETE FROM messages WHERE id <= ?", (batch[-1]["id"],))
+                first = conn.execute("SELECT timestamp FROM messages ORDER BY id LIMIT 1").fetchone()
+                self._bump(conn, count_delta=-len(batch))
+                self._write_stats(conn, remove_stats(stats, compute_stats(batch), first[0] if first else None))
+            removed += len(batch)
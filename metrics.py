@@ -0,0 +1,227 @@
+"""Process-wide timing and traffic metrics for the hot paths.
+
+Every session served by this process records into ``shared_metrics``:
+how long each phase of a rerun took (storage calls, Gist requests, JSON
+parsing and encoding, statistics, rendering), how many bytes went to and
+from the Gist, how often each session reran and how long a sent message
+took to show up on screen. Durations keep the last ``METRIC_SAMPLES``
+samples per phase for percentiles, plus running counts and sums.
+
+The cloud app's admin panel shows the summary; ``prometheus_text`` and
+``log_lines`` export it as a Prometheus text file (for the node
+exporter's textfile collector, say) or as one JSON object per line, and
+``export`` keeps such files up to date.
+"""
+import functools
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from message_log import atomic_write
+
+METRIC_SAMPLES = 1000  # Recent samples kept per phase for percentiles
+METRIC_PREFIX = "ahadchat_"
+PERCENTILES = (0.5, 0.9, 0.99)
+SESSION_IDLE = 3600  # Seconds after which a quiet session stops being listed
+SENT_TRACKED = 1000  # Sent messages remembered for delivery latency
+SENT_MAX_AGE = 300  # Seconds after which a sent message no longer counts as being delivered
+METRICS_EXPORT_INTERVAL = 15  # Seconds between writes of the export files
+
+
+def percentile(ordered, fraction):
+    """Value below which ``fraction`` of the sorted samples ``ordered`` lie (nearest rank)"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Summary:
+    """Running count and sum of observed values, with the latest samples for percentiles"""
+
+    def __init__(self, samples=METRIC_SAMPLES):
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=samples)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def quantiles(self):
+        ordered = sorted(self.samples)
+        return {q: percentile(ordered, q) for q in PERCENTILES}
+
+
+class Metrics:
+    """Durations, counters, reruns per session and delivery latency, safe to share between threads"""
+
+    def __init__(self, samples=METRIC_SAMPLES):
+        self.samples = samples
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._summaries = {}  # (name, labels) -> Summary
+        self._counters = {}  # (name, labels) -> total
+        self._sessions = {}  # session -> {"page": reruns, "fragment": reruns, "seen": last rerun}
+        self._sent = OrderedDict()  # message key -> when it was sent
+        self._exported_at = 0.0
+
+    def observe(self, name, value, **labels):
+        """Record one value (seconds for durations) of the summary ``name``"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = Summary(self.samples)
+            summary.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        """Add ``amount`` to the counter ``name``"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, phase):
+        """Time the block as ``phase``, also when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("duration_seconds", time.perf_counter() - started, phase=phase)
+
+    def timed(self, phase):
+        """Decorator timing every call of a function as ``phase``"""
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(phase):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def rerun(self, session, kind="page"):
+        """Count a rerun of ``session`` (a whole ``page`` or the message list ``fragment``)"""
+        now = time.time()
+        self.increment("reruns_total", kind=kind)
+        with self._lock:
+            counts = self._sessions.setdefault(session, {"page": 0, "fragment": 0})
+            counts[kind] = counts.get(kind, 0) + 1
+            counts["seen"] = now
+            for other in [s for s, c in self._sessions.items() if now - c["seen"] > SESSION_IDLE]:
+                del self._sessions[other]
+
+    def message_sent(self, key):
+        """Remember when the message identified by ``key`` was sent from this process"""
+        with self._lock:
+            self._sent[key] = time.time()
+            self._sent.move_to_end(key)
+            while len(self._sent) > SENT_TRACKED:
+                self._sent.popitem(last=False)
+
+    def messages_shown(self, keys):
+        """Record the send-to-visible latency of messages that just appeared on a screen
+
+        Only messages sent from this process in the last ``SENT_MAX_AGE``
+        seconds count; each session showing one records its own latency.
+        """
+        now = time.time()
+        with self._lock:
+            latencies = [now - self._sent[key] for key in keys if key in self._sent]
+        for latency in latencies:
+            if latency <= SENT_MAX_AGE:
+                self.observe("delivery_seconds", latency)
+
+    def sessions(self):
+        """Rerun counts of the sessions active in the last ``SESSION_IDLE`` seconds"""
+        with self._lock:
+            return {session: dict(counts) for session, counts in self._sessions.items()}
+
+    def summaries(self):
+        """One row per summary: name, labels, count, sum, mean and percentiles"""
+        with self._lock:
+            items = [(key, s.count, s.sum, s.quantiles()) for key, s in self._summaries.items()]
+        rows = []
+        for (name, labels), count, total, quantiles in sorted(items):
+            rows.append({
+                "name": name, "labels": dict(labels), "count": count, "sum": total,
+                "mean": total / count if count else None, "quantiles": quantiles,
+            })
+        return rows
+
+    def counters(self):
+        """One row per counter: name, labels and total"""
+        with self._lock:
+            items = sorted(self._counters.items())
+        return [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in items]
+
+    def prometheus_text(self):
+        """Everything recorded, in the Prometheus text exposition format"""
+        lines = []
+        typed = set()
+        for row in self.summaries():
+            name = METRIC_PREFIX + row["name"]
+            labels = tuple(row["labels"].items())
+            if name not in typed:
+                lines.append(f"# TYPE {name} summary")
+                typed.add(name)
+            for q, value in row["quantiles"].items():
+                lines.append(f"{name}{_labels_text(labels + (('quantile', q),))} {value:.6f}")
+            lines.append(f"{name}_sum{_labels_text(labels)} {row['sum']:.6f}")
+            lines.append(f"{name}_count{_labels_text(labels)} {row['count']}")
+        for row in self.counters():
+            name = METRIC_PREFIX + row["name"]
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_labels_text(tuple(row['labels'].items()))} {row['value']}")
+        name = METRIC_PREFIX + "active_sessions"
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {len(self.sessions())}")
+        return "\n".join(lines) + "\n"
+
+    def log_lines(self):
+        """Everything recorded as a structured log, one JSON object per line"""
+        now = round(time.time(), 3)
+        records = [
+            {"time": now, "metric": row["name"], "labels": row["labels"], "count": row["count"],
+             "sum": round(row["sum"], 6), **{f"p{round(q * 100)}": v for q, v in row["quantiles"].items()}}
+            for row in self.summaries()
+        ]
+        records.extend({"time": now, "metric": row["name"], "labels": row["labels"], "value": row["value"]}
+                       for row in self.counters())
+        records.extend({"time": now, "metric": "session_reruns", "session": session,
+                        "page": counts["page"], "fragment": counts["fragment"]}
+                       for session, counts in self.sessions().items())
+        return "".join(json.dumps(record) + "\n" for record in records)
+
+    def export(self, textfile=None, log=None, interval=METRICS_EXPORT_INTERVAL):
+        """Rewrite ``textfile`` with ``prometheus_text`` and append ``log_lines`` to ``log``
+
+        Does nothing until ``interval`` seconds have passed since the last
+        export, so it can be called on every rerun. Returns True if it wrote.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now - self._exported_at < interval:
+                return False
+            self._exported_at = now
+        if textfile:
+            # Replaced atomically, so a collector never reads half a file
+            with atomic_write(textfile, sync=False) as f:
+                f.write(self.prometheus_text())
+        if log:
+            with open(log, "a", encoding="utf-8") as f:
+                f.write(self.log_lines())
+        return True
+
+# Shared by every session in this process
+shared_metrics = Metrics()
@@ -0,0 +1,40 @@
+"""In-process publish/subscribe notifications for new messages.
+
+Writers publish on a channel (one per message store) after they store
+something; each publish bumps the channel's version number. Readers
+compare the version with the one they last rendered, which costs a
+dictionary lookup, and only touch storage when it moved.
+"""
+import threading
+
+
+class ChangeNotifier:
+    """Version counters per channel that writers bump and readers watch"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._signatures = {}
+
+    def publish(self, channel, signature=None):
+        """Announce a change on ``channel`` and return its new version
+
+        With a ``signature`` (any comparable summary of the stored data)
+        the version only moves when it differs from the last one published,
+        so a reader that reloads unchanged data does not send everyone else to storage.
+        """
+        with self._lock:
+            if signature is not None and self._signatures.get(channel) == signature:
+                return self._versions.get(channel, 0)
+            self._signatures[channel] = signature
+            self._versions[channel] = self._versions.get(channel, 0) + 1
+            return self._versions[channel]
+
+    def version(self, channel):
+        """Current version of ``channel`` (0 before the first publish)"""
+        with self._lock:
+            return self._versions.get(channel, 0)
+
+
+# Shared by every session in this process
+shared_notifier = ChangeNotifier()
@@ -0,0 +1,223 @@
+"""Background retention for the message store.
+
+A ``RetentionPolicy`` limits the hot store by message count, age and
+size. Messages past a limit are not deleted: they are written, oldest
+first, into gzip-compressed NDJSON archive segments (the export format)
+and only then removed from the store, so a crash in between leaves them
+in both places rather than in neither.
+
+The work runs on a background thread. Stores remove archived messages in
+short steps (see ``MessageStore.expire``), so sends and page renders
+carry on meanwhile. Limits have some slack: compaction starts once the
+store is ``RETENTION_SLACK`` past a limit and trims it back to the limit,
+so it runs now and then rather than after every send.
+"""
+import base64
+import itertools
+import os
+import threading
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from message_export import export_chunks
+from message_log import atomic_write, message_id
+from message_stats import message_size
+from message_store import TIMESTAMP_FORMAT
+
+RETENTION_INTERVAL = 600  # Seconds between checks of the limits
+RETENTION_SLACK = 0.1  # How far past a limit the store may grow before compaction starts
+ARCHIVE_SEGMENT_SIZE = 10000  # Messages per archive segment
+ARCHIVE_DIR = "archive"  # Local archive segments, next to the message log
+
+
+def archive_name(first_id, last_id):
+    return f"archive-{first_id:09d}-{last_id:09d}.ndjson.gz"
+
+
+def archive_range(name):
+    """(first ID, last ID) of the archive segment called ``name``"""
+    first_id, last_id = name[len("archive-"):].split(".")[0].split("-")
+    return int(first_id), int(last_id)
+
+
+class RetentionPolicy:
+    """Limits on the hot store; None (or 0) means no limit"""
+
+    def __init__(self, max_messages=None, max_age_days=None, max_bytes=None):
+        self.max_messages = max_messages or None
+        self.max_age_days = max_age_days or None
+        self.max_bytes = max_bytes or None
+
+    def __bool__(self):
+        return any((self.max_messages, self.max_age_days, self.max_bytes))
+
+    def oldest_kept(self, now, slack=0.0):
+        """Timestamp of the oldest message the age limit keeps (None without one)"""
+        if not self.max_age_days:
+            return None
+        return (now - timedelta(days=self.max_age_days * (1 + slack))).strftime(TIMESTAMP_FORMAT)
+
+    def due(self, stats, now):
+        """Whether the store is far enough past a limit to compact"""
+        slack = 1 + RETENTION_SLACK
+        if self.max_messages and stats["total"] > self.max_messages * slack:
+            return True
+        if self.max_bytes and stats["bytes"] > self.max_bytes * slack:
+            return True
+        oldest = self.oldest_kept(now, RETENTION_SLACK)
+        return bool(oldest and stats["first"] and stats["first"] < oldest)
+
+    def cut(self, messages, stats, now):
+        """ID of the oldest message to keep, given every message oldest first"""
+        excess = stats["total"] - self.max_messages if self.max_messages else 0
+        size = stats["bytes"]
+        oldest = self.oldest_kept(now)
+        for position, message in enumerate(messages):
+            if (position < excess
+                    or (oldest and (message.get("timestamp") or "") < oldest)
+                    or (self.max_bytes and size > self.max_bytes)):
+                size -= message_size(message)
+                continue
+            return message_id(message)
+        return stats["last_id"] + 1
+
+
+class LocalArchive:
+    """Archive segments as files in a directory"""
+
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+
+    def write(self, name, data):
+        os.makedirs(self.directory, exist_ok=True)
+        with atomic_write(os.path.join(self.directory, name), "wb") as f:
+            f.write(data)
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), "rb") as f:
+            return f.read()
+
+    def names(self, refresh=True):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(n for n in os.listdir(self.directory) if n.startswith("archive-") and n.endswith(".gz"))
+
+
+class GistArchive:
+    """Archive segments as files in a Gist, base64-encoded since Gist files hold text
+
+    File names start with ``prefix``, so several chat rooms can keep their
+    archives in one Gist.
+    """
+
+    SUFFIX = ".b64"
+
+    def __init__(self, client, prefix=""):
+        self.client = client
+        self.prefix = prefix
+        self._names = None  # As of the last listing, kept up to date by our own writes
+
+    def write(self, name, data):
+        self.client.write_files({self.prefix + name + self.SUFFIX: base64.b64encode(data).decode("ascii")})
+        if self._names is not None:
+            self._names = sorted(set(self._names) | {name})
+
+    def read(self, name):
+        self.client.refresh()
+        return base64.b64decode(self.client.read_file(self.prefix + name + self.SUFFIX) or "")
+
+    def names(self, refresh=True):
+        """Archive segment names; with ``refresh=False`` the last listing, without asking the Gist again"""
+        if refresh or self._names is None:
+            self.client.refresh()
+            start = self.prefix + "archive-"
+            self._names = sorted(
+                n[len(self.prefix):-len(self.SUFFIX)] for n in self.client.file_names()
+                if n.startswith(start) and n.endswith(self.SUFFIX)
+            )
+        return list(self._names)
+
+
+class RetentionEngine:
+    """Applies a retention policy to ``store`` from a background thread, archiving into ``archive``"""
+
+    def __init__(self, store, archive, policy=None, interval=RETENTION_INTERVAL):
+        self.store = store
+        self.archive = archive
+        self.policy = policy or RetentionPolicy()
+        self.interval = interval
+        self.last_run = None  # (finished at, messages archived)
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._requested = None
+        self._thread = None
+
+    def start(self):
+        """Start the background thread (once) and return self"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+                self._thread.start()
+        return self
+
+    def set_policy(self, policy):
+        """Use ``policy`` from now on and check it straight away"""
+        self.policy = policy
+        self._wake.set()
+
+    def run_soon(self, policy=None):
+        """Compact in the background now, once with ``policy`` instead of the configured one if given"""
+        with self._lock:
+            self._requested = policy or self.policy
+        self._wake.set()
+
+    def run_once(self, policy=None, force=False):
+        """Archive and remove what ``policy`` expires, returning how many messages went
+
+        Unless ``force`` is set, nothing happens until the store is past
+        a limit by the slack. Messages the archive already holds (a send
+        that raced with an earlier expiry can put them back for a moment)
+        are removed without being archived twice.
+        """
+        policy = policy or self.policy
+        if not policy:
+            return 0
+        with self._run_lock:
+            stats = self.store.stats()
+            now = datetime.now()
+            if not stats["total"] or not (force or policy.due(stats, now)):
+                return 0
+            with closing(self.store.stream()) as messages:
+                cut = policy.cut(messages, stats, now)
+
+            archived_through = max((archive_range(name)[1] for name in self.archive.names()), default=0)
+            expiring = 0
+            with closing(self.store.stream()) as messages:
+                expired = itertools.takewhile(lambda m: message_id(m) < cut, messages)
+                while True:
+                    chunk = list(itertools.islice(expired, ARCHIVE_SEGMENT_SIZE))
+                    if not chunk:
+                        break
+                    expiring += len(chunk)
+                    chunk = [m for m in chunk if message_id(m) > archived_through]
+                    if chunk:
+                        data = b"".join(export_chunks(chunk, compress=True))
+                        self.archive.write(archive_name(message_id(chunk[0]), message_id(chunk[-1])), data)
+            removed = self.store.expire(cut) if expiring else 0
+            self.last_run = (time.time(), removed)
+            return removed
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                requested, self._requested = self._requested, None
+            try:
+                self.run_once(requested, force=requested is not None)
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e
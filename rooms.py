@@ -0,0 +1,51 @@
+"""Chat rooms and where each one's messages are kept.
+
+Rooms are configured next to the users, as ``{room: {"name": "Family",
+"members": ["khizar", "ahad"]}}``. Every room is its own partition: its
+own message log or SQLite database, or its own files in the Gist, with
+its own statistics, search index and archives. Loading, statistics and
+retention therefore only ever touch the room that is open, and a refresh
+costs the same however many other rooms there are.
+
+``DEFAULT_ROOM`` keeps the names used before rooms existed
+(``messages.jsonl``, ``messages.db``, ``messages.json`` in the Gist), so
+an existing history becomes that room without being moved.
+"""
+import os
+import re
+
+DEFAULT_ROOM = "main"
+ROOM_ID = re.compile(r"^[a-z0-9_]+$")  # Room IDs become part of file names
+
+
+def default_rooms(users):
+    """One room holding every user, as before rooms existed"""
+    return {DEFAULT_ROOM: {"name": "General", "members": list(users)}}
+
+
+def check_rooms(users, rooms):
+    """Raise ValueError unless every room has a usable ID and only known members"""
+    for room, config in rooms.items():
+        if not ROOM_ID.match(room):
+            raise ValueError(f"Room ID {room!r} may only hold lowercase letters, digits and underscores")
+        unknown = set(config.get("members", ())) - set(users)
+        if unknown:
+            raise ValueError(f"Room {room!r} lists unknown members: {', '.join(sorted(unknown))}")
+
+
+def rooms_for(rooms, username):
+    """IDs of the rooms ``username`` belongs to, in configured order"""
+    return [room for room, config in rooms.items() if username in config.get("members", ())]
+
+
+def room_path(path, room):
+    """``path`` for ``room``: ``messages.jsonl`` becomes ``messages-family.jsonl``"""
+    if room == DEFAULT_ROOM:
+        return path
+    base, extension = os.path.splitext(path)
+    return f"{base}-{room}{extension}"
+
+
+def room_prefix(room):
+    """Prefix of ``room``'s file names in a Gist ("" for the default room)"""
+    return "" if room == DEFAULT_ROOM else f"{room}-"
@@ -0,0 +1,214 @@
+"""Full-text search over the chat history.
+
+An inverted index maps every word to the IDs of the messages holding it,
+kept in increasing order, so a search walks the shortest list newest
+first and checks the other words with binary searches instead of reading
+every message. Words are kept sorted for prefix queries (``hel*``), and
+per-user lists and per-day ID ranges narrow results by sender and date.
+
+Messages are indexed one write at a time as they are stored. IDs only
+ever grow, so catching up on messages stored elsewhere means indexing
+everything after the last indexed ID. A rewrite (cleanup) throws the
+index away and it is rebuilt on the next search.
+"""
+import array
+import bisect
+import heapq
+import pickle
+import re
+import threading
+
+from message_log import atomic_write, message_id
+from message_model import to_message
+
+TOKEN_PATTERN = re.compile(r"\w+")
+SEARCH_LIMIT = 50  # Matches returned per search
+INDEX_SAVE_INTERVAL = 1000  # Messages indexed between saves of the index file
+INDEX_FORMAT = 1  # Bump when the saved layout changes; older files are rebuilt
+
+
+def tokenize(text):
+    """Lower-cased words of ``text``"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def parse_query(query):
+    """``(word, prefix)`` pairs of a query; ``word*`` matches every word starting with ``word``"""
+    terms = []
+    for part in query.split():
+        words = tokenize(part)
+        prefix = part.endswith("*")
+        terms.extend((word, prefix and i == len(words) - 1) for i, word in enumerate(words))
+    return terms
+
+
+def _contains(ids, value):
+    i = bisect.bisect_left(ids, value)
+    return i < len(ids) and ids[i] == value
+
+
+def _descending(ids, high):
+    for i in range(bisect.bisect_right(ids, high) - 1, -1, -1):
+        yield ids[i]
+
+
+def _newest_first(lists, high):
+    """IDs up to ``high`` from several increasing lists, merged newest first without repeats"""
+    if len(lists) == 1:
+        yield from _descending(lists[0], high)
+        return
+    previous = None
+    for value in heapq.merge(*(_descending(ids, high) for ids in lists), reverse=True):
+        if value != previous:
+            yield value
+            previous = value
+
+
+class SearchIndex:
+    """Inverted index over message text, updated as messages are stored
+
+    ``add`` can also record where each message is stored (a byte offset in
+    the message log) so matches are read directly rather than found by a
+    scan; see ``location``.
+    """
+
+    def __init__(self):
+        self.postings = {}  # word -> IDs of the messages holding it
+        self.users = {}  # username -> IDs of their messages
+        self.days = {}  # "YYYY-MM-DD" -> [lowest ID, highest ID] sent that day
+        self.ids = array.array("I")  # Indexed IDs with a recorded location...
+        self.locations = array.array("Q")  # ...and the locations, in the same order
+        self.last_id = 0
+        self.count = 0
+        self.unsaved = 0  # Messages indexed since the index was last saved
+        self._words = None  # Sorted words for prefix queries, rebuilt when new words appear
+        self._lock = threading.RLock()
+
+    def add(self, messages, locations=None):
+        """Index messages newer than the last indexed one, oldest first (older ones are skipped)"""
+        with self._lock:
+            for i, message in enumerate(messages):
+                message = to_message(message)
+                doc = message.id or 0
+                if doc <= self.last_id:
+                    continue
+                for word in set(tokenize(message.text or "")):
+                    ids = self.postings.get(word)
+                    if ids is None:
+                        ids = self.postings[word] = array.array("I")
+                        self._words = None
+                    ids.append(doc)
+                self.users.setdefault(message.user, array.array("I")).append(doc)
+                self.days.setdefault(message.day, [doc, doc])[1] = doc
+                if locations is not None:
+                    self.ids.append(doc)
+                    self.locations.append(locations[i])
+                self.last_id = doc
+                self.count += 1
+                self.unsaved += 1
+
+    def append(self, messages):
+        """Index just-stored messages if they directly follow the last indexed one
+
+        Returns False, indexing nothing, when other messages were stored in
+        between; catching up on those is left to the next search.
+        """
+        with self._lock:
+            if not messages or message_id(messages[0]) != self.last_id + 1:
+                return False
+            self.add(messages)
+            return True
+
+    def location(self, doc):
+        """Where message ``doc`` is stored, or None if not recorded"""
+        i = bisect.bisect_left(self.ids, doc)
+        if i < len(self.ids) and self.ids[i] == doc:
+            return self.locations[i]
+        return None
+
+    def _lists(self, word, prefix):
+        if not prefix:
+            ids = self.postings.get(word)
+            return [ids] if ids else []
+        if self._words is None:
+            self._words = sorted(self.postings)
+        lists = []
+        for i in range(bisect.bisect_left(self._words, word), len(self._words)):
+            if not self._words[i].startswith(word):
+                break
+            lists.append(self.postings[self._words[i]])
+        return lists
+
+    def _id_range(self, start, end):
+        """Lowest and highest ID sent between the days of ``start`` and ``end`` (None if none)"""
+        if start is None and end is None:
+            return 0, self.last_id
+        spans = [
+            span for day, span in self.days.items()
+            if (start is None or day >= start[:10]) and (end is None or day <= end[:10])
+        ]
+        if not spans:
+            return None
+        return min(s[0] for s in spans), max(s[1] for s in spans)
+
+    def search(self, query, users=None, start=None, end=None, limit=SEARCH_LIMIT):
+        """IDs of up to ``limit`` messages holding every word of ``query``, newest first
+
+        ``users`` limits the senders. ``start`` and ``end`` are timestamps
+        as in ``MessageStore.stream`` and are matched by day here, so callers
+        check the exact times of what comes back.
+        """
+        terms = parse_query(query)
+        if not terms or limit <= 0:
+            return []
+        with self._lock:
+            groups = [self._lists(word, prefix) for word, prefix in terms]
+            if not all(groups):
+                return []
+            id_range = self._id_range(start, end)
+            if id_range is None:
+                return []
+            low, high = id_range
+            senders = None
+            if users is not None:
+                senders = [self.users[u] for u in users if u in self.users]
+                if not senders:
+                    return []
+
+            # Walk the rarest word's messages and look the rest up
+            groups.sort(key=lambda lists: sum(len(ids) for ids in lists))
+            found = []
+            for doc in _newest_first(groups[0], high):
+                if doc < low:
+                    break
+                if senders is not None and not any(_contains(ids, doc) for ids in senders):
+                    continue
+                if all(any(_contains(ids, doc) for ids in lists) for lists in groups[1:]):
+                    found.append(doc)
+                    if len(found) >= limit:
+                        break
+            return found
+
+    def save(self, path):
+        """Save the index to ``path``, replacing the file atomically"""
+        with self._lock:
+            state = {key: value for key, value in self.__dict__.items() if not key.startswith("_")}
+            state["format"] = INDEX_FORMAT
+            with atomic_write(path, "wb", sync=False) as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.unsaved = 0
+
+
+def load_index(path):
+    """Index saved at ``path``, or None if missing, unreadable or in an older format"""
+    try:
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+    if not isinstance(state, dict) or state.pop("format", None) != INDEX_FORMAT:
+        return None
+    index = SearchIndex()
+    index.__dict__.update(state)
+    index.unsaved = 0
+    return index
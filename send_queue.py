@@ -0,0 +1,89 @@
+"""Write-behind queue for outgoing cloud messages.
+
+Sending a message only appends it to a local spool file and returns. A
+background thread merges everything that is pending into one write per
+flush interval and retries with backoff when the write fails. The spool
+is replayed on start, so queued messages survive a process restart.
+"""
+import threading
+import time
+
+from message_log import append_message, read_messages, write_messages
+
+SEND_SPOOL_FILE = "outbox.jsonl"
+SEND_FLUSH_INTERVAL = 1.0  # Seconds between batched writes
+SEND_MAX_BACKOFF = 30.0  # Longest wait between retries after failures
+
+
+class SendQueue:
+    """Pending messages that a background thread hands to ``flush`` in batches
+
+    ``flush(batch)`` must store every message of ``batch`` or raise; the
+    batch stays queued until a call succeeds. Delivery is at-least-once: a
+    crash between a successful write and the spool update resends the batch.
+    """
+
+    def __init__(self, flush, spool_path=SEND_SPOOL_FILE, interval=SEND_FLUSH_INTERVAL, max_backoff=SEND_MAX_BACKOFF):
+        self.flush_batch = flush
+        self.spool_path = spool_path
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = read_messages(spool_path)
+        self._thread = None
+        if self._pending:
+            # Left over from before a restart
+            self._wake.set()
+
+    def start(self):
+        """Start the background flusher (once) and return self"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="send-queue", daemon=True)
+                self._thread.start()
+        return self
+
+    def put(self, message):
+        """Queue a message; it is durable once this returns"""
+        with self._lock:
+            append_message(message, self.spool_path)
+            self._pending.append(message)
+        self._wake.set()
+
+    def pending(self):
+        """Messages queued but not yet written"""
+        with self._lock:
+            return list(self._pending)
+
+    def flush(self):
+        """Write every pending message now, returning how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending)
+            if not batch:
+                return 0
+            self.flush_batch(batch)
+            with self._lock:
+                # Messages queued during the write stay for the next batch
+                self._pending = self._pending[len(batch):]
+                write_messages(self._pending, self.spool_path)
+            return len(batch)
+
+    def _run(self):
+        delay = self.interval
+        while True:
+            self._wake.wait()
+            # Messages sent during this pause go out in the same batch
+            time.sleep(delay)
+            self._wake.clear()
+            try:
+                self.flush()
+                self.last_error = None
+                delay = self.interval
+            except Exception as e:
+                self.last_error = e
+                delay = min(delay * 2, self.max_backoff)
+                self._wake.set()
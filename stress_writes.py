@@ -0,0 +1,123 @@
+"""Stress test for concurrent sends.
+
+Several writers send messages as fast as they can into one store, then
+the store is read back and checked: every message must be there exactly
+once and IDs must be unique and increasing.
+
+    python stress_writes.py jsonl --writers 8 --messages 500
+    python stress_writes.py sqlite --writers 8 --messages 500
+    python stress_writes.py gist --writers 4 --messages 50 --latency 0.02
+    python stress_writes.py gist --writers 4 --messages 50 --latency 0.02 --poll 0.01
+
+``jsonl`` and ``sqlite`` writers are separate processes, as if several
+Streamlit servers shared one directory. ``gist`` writers are threads
+with a client each (as separate servers would have) against
+``fake_gist_server``; ``--latency`` widens the window between reading
+and writing the Gist. With ``--poll`` each writer's client is also
+refreshed by a ``GistPoller`` every so many seconds, as on a server where
+sessions send while the poller reads.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from message_log import message_id
+from message_store import JsonFileStore, SqliteStore
+
+
+def open_store(backend, path, server_url=None, segment_size=None, poll=None):
+    if backend == "jsonl":
+        return JsonFileStore(path, legacy_path=None)
+    if backend == "sqlite":
+        return SqliteStore(path)
+
+    from gist_client import GistClient
+    from gist_segments import SegmentedGist
+    client = GistClient("stress", "local", api_url=server_url)
+    store = SegmentedGist(client, segment_size=segment_size, polled=poll is not None)
+    if poll is not None:
+        from gist_poller import GistPoller
+        poller = GistPoller(client, active_interval=poll, idle_interval=poll, reserve=0, watch_timeout=float("inf"))
+        poller.watch(store)
+        poller.start()
+    return store
+
+
+def run_writer(backend, path, writer, count, server_url=None, segment_size=None, poll=None):
+    store = open_store(backend, path, server_url, segment_size, poll)
+    for n in range(count):
+        store.add(f"writer{writer}", f"message {n}")
+
+
+def check(messages, writers, count):
+    """Return a list of problems with the stored messages (empty if none)"""
+    problems = []
+    sent = Counter((f"writer{w}", f"message {n}") for w in range(writers) for n in range(count))
+    stored = Counter((m["username"], m["message"]) for m in messages)
+    lost = sent - stored
+    duplicated = stored - sent
+    if lost:
+        problems.append(f"{sum(lost.values())} messages lost")
+    if duplicated:
+        problems.append(f"{sum(duplicated.values())} messages duplicated")
+    ids = [message_id(m) for m in messages]
+    if len(set(ids)) != len(ids):
+        problems.append(f"{len(ids) - len(set(ids))} IDs reused")
+    if ids != sorted(ids):
+        problems.append("IDs out of order")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send messages from many writers at once and check none are lost")
+    parser.add_argument("backend", choices=["jsonl", "sqlite", "gist"])
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=200, help="messages per writer")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every Gist request")
+    parser.add_argument("--segment-size", type=int, default=100, help="messages per sealed Gist segment")
+    parser.add_argument("--poll", type=float, default=None,
+                        help="seconds between polls of each Gist writer's client by a background poller")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "messages.db" if args.backend == "sqlite" else "messages.jsonl")
+        server_url = None
+        if args.backend == "gist":
+            from fake_gist_server import FakeGistServer
+            server = FakeGistServer(latency=args.latency).start()
+            server.store.create("stress")
+            server_url = server.url
+            writers = [
+                threading.Thread(target=run_writer, args=(args.backend, path, w, args.messages, server_url, args.segment_size, args.poll))
+                for w in range(args.writers)
+            ]
+        else:
+            # Create the file up front so writers do not race to set it up
+            open_store(args.backend, path)
+            writers = [
+                multiprocessing.Process(target=run_writer, args=(args.backend, path, w, args.messages))
+                for w in range(args.writers)
+            ]
+
+        started = time.perf_counter()
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        elapsed = time.perf_counter() - started
+
+        messages = open_store(args.backend, path, server_url, args.segment_size).all()
+        total = args.writers * args.messages
+        print(f"{args.backend}: {total} messages from {args.writers} writers in {elapsed:.2f}s "
+              f"({total / elapsed:.0f} messages/s), {len(messages)} stored")
+        problems = check(messages, args.writers, args.messages)
+        print("FAILED: " + ", ".join(problems) if problems else "OK: nothing lost or duplicated")
+        raise SystemExit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()